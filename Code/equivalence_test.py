@@ -2,310 +2,976 @@
 A sub-part of the runner script which justs tests the equivalence of the file
 passes as arguments to the script. Just used for quick testing for the
 correctness of th algorithm.
+
+Both files are read in large pieces and parsed with NumPy. The blocks of each
+chunk of the output are painted onto a grid of the cells of the chunk's slab,
+counting how many blocks cover each cell, and the grid is compared with the
+same slab of the input, so the memory used is bounded by the size of a slab
+however large the model is.
+
+The chunks are independent, so they are checked at once in a pool of
+processes. It can also be used from Python, e.g.
+    result = verify("input.csv", "output.csv")
+    if not result:
+        print(result.error)
 """
 
+import argparse
+import concurrent.futures
 import sys
 import os
 import io
 import typing
-from operator import itemgetter
+import numpy as np
+
+
+class VerificationError(Exception):
+    """
+    An error found in one of the files, with the exit status of the script
+
+    Parameters:
+        message The diagnostic, as it is printed
+        status  The exit status: 1 for an error in a file, 100 when a file
+                ends too soon, and 200 or 300 when it can't be read
+    """
+
+    def __init__(self, message: str, status: int = 1):
+        super(VerificationError, self).__init__(message, status)
+        self.message = message
+        self.status = status
+
+    def __str__(self):
+        return self.message
+
+
+# the format of a row, as it is reported in errors
+ROW_FORMAT = "x, y, z, sx, sy, sz, string"
 
 
-def get_header_info_of_file1(file1: io.IOBase, line: str, line_count: int, stderr) -> typing.List[int]:     # noqa
+def get_header_info_of_file1(
+        file1: io.IOBase, line_count: int) -> typing.List[int]:
     try:
         line = file1.readline()
-        if line == "":
-            print("Error: unexpected end of input on line {}".format(
-                line_count),
-                file=stderr)
-            sys.exit(100)
+        if isinstance(line, bytes):
+            line = line.decode()
     except OSError as err:
-        print("Error: failed to read line {} ({})".format(
+        raise VerificationError("Error: failed to read line {} ({})".format(
             line_count,
-            err.strerror),
-            file=stderr)
-        sys.exit(200)
-    except:
-        print("Error: failed to read line {} ({})".format(
+            err.strerror), 200)
+    except Exception:
+        raise VerificationError("Error: failed to read line {} ({})".format(
             line_count,
-            sys.exc_info()[0]),
-            file=stderr)
-        sys.exit(300)
-    return parse_line1_of_file1(line, line_count, stderr)
+            sys.exc_info()[0]), 300)
+    if line == "":
+        raise VerificationError(
+            "Error: unexpected end of input on line {}".format(line_count),
+            100)
+    return parse_line1_of_file1(line, line_count)
 
 
-def parse_line1_of_file1(line: str, line_count: int, stderr) -> typing.List[int]:
+def parse_line1_of_file1(line: str, line_count: int) -> typing.List[int]:
     if line[0] != "#":
-        print("Error: line {} expected '# x,y,z,px,py,pz' and instead found {}.".format(    # noqa
-            line_count,
-            line),
-            file=stderr)
-        sys.exit(1)
+        raise VerificationError(
+            "Error: line {} expected '# x,y,z,px,py,pz' and instead "
+            "found {}.".format(
+                line_count,
+                line))
     try:
         ints = [int(i) for i in line[1:].split(',')]
     except ValueError as err:
-        print("line {}: {}Error: {}".format(
+        raise VerificationError("line {}: {}Error: {}".format(
             line_count,
             line,
-            err),
-            file=stderr)
-        sys.exit(1)
+            err))
     if len(ints) != 6:
-        print("line {}: {}Error: expecting line to be six integers of the format:".format(  # noqa
-            line_count,
-            line),
-            file=stderr)
-        print("# <x_count>, <y_count>, <z_count>, <x_parent_size>, <y_parent_size>, <z_parent_size>",   # noqa
-              file=stderr)
-        sys.exit(1)
+        raise VerificationError(
+            "line {}: {}Error: expecting line to be six integers of the "
+            "format:\n".format(
+                line_count,
+                line) +
+            "# <x_count>, <y_count>, <z_count>, <x_parent_size>, "
+            "<y_parent_size>, <z_parent_size>")
     return ints
 
 
-def read_next_line_of_input(file, line_count, stderr):
-    try:
-        while True:
-            line = file.readline()
-            line_count += 1
-            if len(line) == 0:
-                break
-            elif line[0] == '#' or line[0] == '\n' or line[0] == '\r':
-                # Ignore comment lines and blank lines
-                continue
-            else:
-                break
-    except OSError as err:
-        print("Error: failed to read line {} ({})".format(
-            line_count,
-            err.strerror),
-            file=stderr)
-        sys.exit(200)
-    except:
-        print("Error: failed to read line {} ({})".format(
-            line_count,
-            sys.exc_info()[0]),
-            file=stderr)
-        sys.exit(300)
-    return line, line_count
-
-
-def file_format_error_and_exit(line: str, line_count: int, stderr):
-    print("line {}: {}Error: expecting format '{}'".format(
-        line_count,
-        line,
-        "x, y, z, sx, sy, sz, string"),
-        file=stderr)
-    sys.exit(1)
-
-
-def parse_and_check_line_of_file1(x: int, y: int, z:int, line: str, line_count: int, stderr, domains: typing.Dict):
+def split_line(line: str, line_count: int):
+    """
+    Splits a row into its 6 integers and its domain, raising a
+    VerificationError if it isn't in the format of a row
+    """
     last_comma = line.rfind(",")
     if last_comma == -1:
-        file_format_error_and_exit(line, line_count, stderr)
+        raise VerificationError(
+            "line {}: {}Error: expecting format '{}'".format(
+                line_count,
+                line,
+                ROW_FORMAT))
     domain = line[last_comma+1:].strip("' \n\r")
-    domains[domain] = domains.get(domain, 0) + 1
     try:
         ints = [int(i) for i in line[0:last_comma].split(',')]
     except ValueError as err:
-        print("line {}: {}Error: {}".format(
-            line_count,
-            line,
-            err),
-            file=stderr)
-        sys.exit(1)
-    if ints[0] != x:
-        print("line {}: {}Error: expected x index to be {} in format x,y,z,px,py,pz,string".format(
-            line_count,
-            line,
-            x),
-            file=stderr)
-        sys.exit(1)
-    if ints[1] != y:
-        print("line {}: {}Error: expected y index to be {} in format x,y,z,px,py,pz,string".format(
-            line_count,
-            line,
-            y),
-            file=stderr)
-        sys.exit(1)
-    if ints[2] != z:
-        print("line {}: {}Error: expected z index to be {} in format x,y,z,px,py,pz,string".format(
+        raise VerificationError("line {}: {}Error: {}".format(
             line_count,
             line,
-            z),
-            file=stderr)
-        sys.exit(1)
+            err))
+    if len(ints) != 6:
+        raise VerificationError(
+            "line {}: {}Error: expecting format '{}'".format(
+                line_count,
+                line,
+                ROW_FORMAT))
+    return ints, domain
+
+
+def parse_and_check_line_of_file1(
+        x: int, y: int, z: int, line: str, line_count: int):
+    """
+    Parses a row of the input, which must be the unit sized block at x, y, z
+    """
+    ints, domain = split_line(line, line_count)
+    for axis, index, expected in zip('xyz', ints, (x, y, z)):
+        if index != expected:
+            raise VerificationError(
+                "line {}: {}Error: expected {} index to be {} in format "
+                "x,y,z,px,py,pz,string".format(
+                    line_count,
+                    line,
+                    axis,
+                    expected))
+    if ints[3] < 0 or ints[4] < 0 or ints[5] < 0:
+        raise VerificationError(
+            "line {}: {}Error: expecting positive block sizes only".format(
+                line_count,
+                line))
     if ints[3] != 1 or ints[4] != 1 or ints[5] != 1:
-        print("line {}: {}Error: expecting unit sized blocks only".format(
-            line_count,
-            line),
-            file=stderr)
-        sys.exit(1)
+        raise VerificationError(
+            "line {}: {}Error: expecting unit sized blocks only".format(
+                line_count,
+                line))
     return ints[0], ints[1], ints[2], ints[3], ints[4], ints[5], domain
 
 
 def parse_line(
-    line: str,
-    line_count: int,
-    parent_size_x: int,
-    parent_size_y: int,
-    parent_size_z: int,
-    stderr):
-    last_comma = line.rfind(",")
-    if last_comma == -1:
-        file_format_error_and_exit(line, line_count, stderr)
-    domain = line[last_comma+1:].strip("' \n\r")
-    try:
-        ints = [int(i) for i in line[0:last_comma].split(',')]
-    except ValueError as err:
-        print("line {}: {}Error: {}".format(
-            line_count,
-            line,
-            err),
-            file=stderr)
-        sys.exit(1)
+        line: str,
+        line_count: int,
+        parent_size_x: int,
+        parent_size_y: int,
+        parent_size_z: int):
+    ints, domain = split_line(line, line_count)
     if ints[3] < 0 or ints[4] < 0 or ints[5] < 0:
-        print("line {}: {}Error: expecting positive block sizes only".format(
-            line_count,
-            line),
-            file=stderr)
-        sys.exit(1)
-    if ints[3] > parent_size_x or ints[4] > parent_size_y or ints[5] > parent_size_z:
-        print("line {}: {}Error: block is too large".format(
+        raise VerificationError(
+            "line {}: {}Error: expecting positive block sizes only".format(
+                line_count,
+                line))
+    if ints[3] > parent_size_x or ints[4] > parent_size_y or \
+            ints[5] > parent_size_z:
+        raise VerificationError("line {}: {}Error: block is too large".format(
             line_count,
-            line),
-            file=stderr)
-        sys.exit(1)
+            line))
     return ints[0], ints[1], ints[2], ints[3], ints[4], ints[5], domain
 
 
-strnull = open(os.devnull, 'w')
-stdout = sys.stdout
-stderr = sys.stderr
-stdvout = sys.stderr
-
-with open(sys.argv[1], "r") as file1, open(sys.argv[2], "r") as file2:
-    line_f1 = ""
-    line_count_f1 = 1
-    ints = get_header_info_of_file1(file1, line_f1, line_count_f1, stderr)
-    x_count = ints[0]
-    y_count = ints[1]
-    z_count = ints[2]
-    block_count_f1 = x_count * y_count * z_count
-    parent_size_x = ints[3]
-    parent_size_y = ints[4]
-    parent_size_z = ints[5]
-    print("...looking for {} blocks.".format(x_count * y_count * z_count),
-          file=stdvout)
-            
-    # We now have sufficient info from file1 to start reading in the first
-    # chunk of file2. A chunk is all the blocks in a parent_size_z run of
-    # consecutive slices in z.
-    line_count_f2 = 0
-    line_f2, line_count_f2 = read_next_line_of_input(file2, line_count_f2, stderr)
-    if line_f2 == "":
-        print("Error: unexpected end of input on line {}".format(
-            line_count_f2),
-            file=stderr)
-        sys.exit(100)
-    line_count_f2_last_chunk_end = 0
-    block_count_f2 = 0
-    for z in range(0, z_count, parent_size_z):
-        print("...reading chunk {} of {}".format(
-            z // parent_size_z + 1, z_count // parent_size_z),
-            file=stdvout)
-        chunk_list = []
+# The number of bytes of a file read at a time
+READ_SIZE = 1 << 22
+
+# The number of cells painted at a time, which bounds the memory used to
+# explode the blocks of a chunk
+PAINT_CELLS = 1 << 22
+
+# The bytes stripped from each end of a domain
+STRIP = np.frombuffer(b"' \n\r", np.uint8)
+
+# The longest number, and domain, the fast parser reads. Anything longer is
+# left to parse_line() and parse_and_check_line_of_file1()
+MAX_NUMBER = 18
+MAX_DOMAIN = 256
+
+
+def gather(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+           fill: int) -> np.ndarray:
+    """
+    Copies each range of the buffer into a row of a 2D array, padded at the
+    end with the fill byte
+    """
+    lengths = np.maximum(ends - starts, 0)
+    width = max(int(lengths.max()), 1) if len(lengths) else 1
+    rows = np.empty((len(starts), width), np.uint8)
+    last = len(buffer) - 1
+    for column in range(width):
+        rows[:, column] = np.where(
+            column < lengths, buffer[np.minimum(starts + column, last)], fill)
+    return rows
+
+
+def parse_integers(
+        fields: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Parses the rows of a 2D array of bytes as integers, each of which must be
+    a run of digits with only spaces around it.
+
+    Returns the values, and whether each row was an integer
+    """
+    values = np.zeros(len(fields), np.int64)
+    ok = np.ones(len(fields), bool)
+    runs = np.zeros(len(fields), np.int8)
+    previous = np.zeros(len(fields), bool)
+    for column in range(fields.shape[1]):
+        field = fields[:, column]
+        digit = field - np.uint8(ord('0'))
+        is_digit = digit < 10
+        ok &= is_digit | (field == ord(' ')) | (field == ord('\t'))
+        runs += is_digit & ~previous
+        previous = is_digit
+        values = np.where(is_digit, values * 10 + digit, values)
+    ok &= runs == 1
+    return values, ok
+
+
+class Rows:
+    """
+    The rows of a block model file, parsed into arrays. The rows the fast
+    parser couldn't read are marked as bad, and are parsed when they are
+    reached, by parse_line() with repair() in the output and by
+    parse_and_check_line_of_file1() in the input, so any error in them is
+    reported the same way, and in the same order, as it always has been.
+
+    Attributes:
+        data    The bytes of the lines of the rows
+        starts  The start of each row in the data
+        ends    The end of each row in the data, after its newline
+        lines   The line number of each row
+        values  The x, y, z, sx, sy and sz of each row, as a (n, 6) array
+        tags    The number of the domain of each row, see parse_rows()
+        bad     Whether each row is still to be parsed
+    """
+
+    def __init__(self, data, starts, ends, lines, values, tags, bad):
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+        self.lines = lines
+        self.values = values
+        self.tags = tags
+        self.bad = bad
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index: slice):
+        return Rows(self.data, self.starts[index], self.ends[index],
+                    self.lines[index], self.values[index], self.tags[index],
+                    self.bad[index])
+
+    def line(self, i: int) -> str:
+        """Gets the text of a row, as it was in the file"""
+        return self.data[self.starts[i]:self.ends[i]].decode(errors='replace')
+
+    def repair(self, i: int, limits, domains: typing.Dict):
+        """
+        Parses a bad row of the output with parse_line(), which raises a
+        VerificationError if it is an error
+        """
+        self.set(i, parse_line(self.line(i), int(self.lines[i]), *limits),
+                 domains)
+
+    def set(self, i: int, parsed, domains: typing.Dict):
+        """Sets a row to the numbers and domain parsed from its line"""
+        *values, domain = parsed
+        self.values[i] = values
+        self.tags[i] = domains.setdefault(domain, len(domains))
+        self.bad[i] = False
+
+    @staticmethod
+    def join(rows: typing.List['Rows']) -> 'Rows':
+        """Joins consecutive rows into one"""
+        rows = [r for r in rows if len(r)]
+        if len(rows) == 1:
+            return rows[0]
+        if not rows:
+            return parse_rows(b'', 1, {})[0]
+        data = []
+        offsets = []
+        offset = 0
+        for r in rows:
+            first = int(r.starts[0])
+            data.append(r.data[first:int(r.ends[-1])])
+            offsets.append(offset - first)
+            offset += len(data[-1])
+        return Rows(
+            b''.join(data),
+            np.concatenate([r.starts + o for r, o in zip(rows, offsets)]),
+            np.concatenate([r.ends + o for r, o in zip(rows, offsets)]),
+            np.concatenate([r.lines for r in rows]),
+            np.concatenate([r.values for r in rows]),
+            np.concatenate([r.tags for r in rows]),
+            np.concatenate([r.bad for r in rows]))
+
+
+def parse_rows(data: bytes, first_line: int,
+               domains: typing.Dict) -> typing.Tuple[Rows, int]:
+    """
+    Parses whole lines of a block model file at once with NumPy, skipping
+    comment lines and blank lines. The domains are numbered in the order they
+    are first seen, in the domains dict shared by both files.
+
+    Returns the Rows, and the number of lines in the data
+    """
+    buffer = np.frombuffer(data, np.uint8)
+    newlines = np.flatnonzero(buffer == ord('\n'))
+    starts = np.concatenate(([0], newlines[:-1] + 1)).astype(np.int64)
+    starts = starts[:len(newlines)]
+    ends = newlines + 1
+    lines = first_line + np.arange(len(newlines))
+    first = buffer[starts]
+    keep = (first != ord('#')) & (first != ord('\n')) & (first != ord('\r'))
+    starts, ends, lines = starts[keep], ends[keep], lines[keep]
+    n = len(starts)
+
+    # the 6 numbers are before the first 6 commas, and the domain is after
+    # the last comma, which must be the sixth
+    commas = np.append(np.flatnonzero(buffer == ord(',')), len(buffer))
+    first_comma = np.searchsorted(commas, starts)
+    last_comma = np.searchsorted(commas, ends) - 1
+    ok = last_comma - first_comma == 5
+    bounds = commas[np.minimum(first_comma[:, None] + np.arange(6),
+                               len(commas) - 1)]
+    field_starts = np.column_stack((starts, bounds[:, :5] + 1))
+    field_ends = bounds
+    lengths = field_ends - field_starts
+    ok &= (lengths <= MAX_NUMBER).all(axis=1)
+    field_ends = np.where(ok[:, None], field_ends, field_starts)
+    values, numbers_ok = parse_integers(
+        gather(buffer, field_starts.ravel(), field_ends.ravel(), ord(' ')))
+    values = values.reshape(n, 6)
+    ok &= numbers_ok.reshape(n, 6).all(axis=1)
+
+    # strip the quotes and spaces from each end of the domains
+    domain_starts = commas[np.maximum(last_comma, 0)] + 1
+    domain_ends = np.where(ok & (ends - domain_starts <= MAX_DOMAIN),
+                           ends, domain_starts)
+    ok &= ends - domain_starts <= MAX_DOMAIN
+    padded = gather(buffer, domain_starts, domain_ends, STRIP[0])
+    kept = ~np.isin(padded, STRIP)
+    width = padded.shape[1]
+    left = np.argmax(kept, axis=1)
+    right = np.where(kept.any(axis=1), width - np.argmax(kept[:, ::-1], axis=1),
+                     left)
+    names = gather(buffer, domain_starts + left, domain_starts + right, 0)
+    tags = np.zeros(n, np.int64)
+    if n:
+        names = np.ascontiguousarray(names).view(
+            np.dtype((np.void, names.shape[1]))).ravel()
+        unique, inverse = np.unique(names, return_inverse=True)
+        numbers = np.array([
+            domains.setdefault(name.tobytes().rstrip(b'\0').decode(),
+                               len(domains))
+            for name in unique], np.int64)
+        tags = numbers[inverse.ravel()]
+    rows = Rows(data, starts, ends, lines, values, tags, ~ok)
+    return rows, len(newlines)
+
+
+class RowReader:
+    """
+    Reads the rows of a block model file in large pieces, and parses them
+    with parse_rows()
+
+    Parameters:
+        file        The file, opened in binary mode, at the first row to read
+        line_count  The number of lines before that row
+        domains     The numbers of the domains, shared by both files
+        end         The position in the file to stop reading at. It defaults
+                    to the end of the file
+    """
+
+    def __init__(self, file: io.IOBase, line_count: int, domains: typing.Dict,
+                 end: int = None):
+        self.file = file
+        self.line_count = line_count
+        self.domains = domains
+        self.end = end
+        self.position = file.tell()
+        self.pending = b''
+        self.eof = False
+
+    @property
+    def finished(self) -> bool:
+        """Whether every row has been read"""
+        return not self.pending and (self.eof or self.position == self.end)
+
+    def _read(self, size: int) -> bytes:
+        if self.end is not None:
+            size = min(size, self.end - self.position)
+        try:
+            data = self.file.read(size) if size > 0 else b''
+        except OSError as err:
+            raise VerificationError("Error: failed to read line {} ({})".format(
+                self.line_count + 1,
+                err.strerror), 200)
+        self.position += len(data)
+        if not data:
+            self.eof = True
+        return data
+
+    def read(self, count: int = None) -> Rows:
+        """
+        Reads the next count rows, or fewer if the file ends first. Without a
+        count, it reads all the rows in the next READ_SIZE bytes or so.
+        """
+        parts = []
+        left = count
         while True:
-            x2, y2, z2, xs2, ys2, zs2, domain = parse_line(
-                line_f2,
-                line_count_f2,
-                parent_size_x,
-                parent_size_y,
-                parent_size_z,
-                stderr)
+            if count is None:
+                data = self.pending + self._read(READ_SIZE)
+                end = data.rfind(b'\n') + 1
+            else:
+                # read until there are enough lines, some of which might be
+                # comments, and cut the data after the last one needed
+                pieces = [self.pending]
+                found = self.pending.count(b'\n')
+                while found < left and not self.eof:
+                    piece = self._read(max(READ_SIZE, (left - found) * 32))
+                    pieces.append(piece)
+                    found += piece.count(b'\n')
+                data = b''.join(pieces)
+                if found >= left:
+                    buffer = np.frombuffer(data, np.uint8)
+                    end = int(np.flatnonzero(buffer == ord('\n'))[left - 1]) + 1
+                else:
+                    if data and not data.endswith(b'\n'):
+                        # the last line has no newline
+                        data += b'\n'
+                    end = len(data)
+            if self.eof and end < len(data):
+                # the last line has no newline
+                data = data + b'\n'
+                end = len(data)
+            self.pending = data[end:]
+            rows, lines = parse_rows(
+                data[:end], self.line_count + 1, self.domains)
+            self.line_count += lines
+            parts.append(rows)
+            if count is not None:
+                left -= len(rows)
+            if (count is None and (len(rows) or self.eof)) or \
+                    (count is not None and left == 0) or self.finished:
+                return Rows.join(parts)
+
+    def read_all(self) -> Rows:
+        """Reads all the rows left"""
+        parts = []
+        while not self.finished:
+            parts.append(self.read())
+        return Rows.join(parts)
+
+
+def paint(rows: Rows, z: int, x_count: int, y_count: int, z_count: int):
+    """
+    Paints the blocks of a chunk onto grids of the cells of the slab from z,
+    in z, y, x order, the same order as the input.
+
+    Returns the number of blocks covering each cell, and the domain number and
+    line number of the last block painted on each cell
+    """
+    size = x_count * y_count * z_count
+    counts = np.zeros(size, np.int32)
+    tags = np.full(size, -1, np.int64)
+    lines = np.zeros(size, np.int64)
+    x, y, z2, xs, ys, zs = rows.values.T
+    volumes = xs * ys * zs
+    ends = np.cumsum(volumes)
+    first = 0
+    while first < len(rows):
+        # explode as many blocks as fit in PAINT_CELLS cells, or at least 1
+        last = max(int(np.searchsorted(
+            ends, ends[first] - volumes[first] + PAINT_CELLS, 'right')),
+            first + 1)
+        piece = slice(first, last)
+        v = volumes[piece]
+        block = np.repeat(np.arange(first, last), v)
+        offset = np.arange(len(block)) - np.repeat(np.cumsum(v) - v, v)
+        bx = xs[block]
+        by = ys[block]
+        cells = (((z2[block] - z + offset // (bx * by)) * y_count +
+                  y[block] + offset // bx % by) * x_count +
+                 x[block] + offset % bx)
+        np.add.at(counts, cells, 1)
+        tags[cells] = rows.tags[block]
+        lines[cells] = rows.lines[block]
+        first = last
+    return counts, tags, lines
+
+
+class Chunk:
+    """
+    A chunk of the model to verify: the blocks of the output in a
+    parent_size_z run of consecutive slices in z, and the same slab of the
+    input. The chunks are independent, so they can be checked in any order,
+    or at once.
+
+    Attributes:
+        index           The index of the chunk, from 0
+        z               The z of the first slice of the chunk
+        header          The 6 numbers from the header of the input
+        last            Whether it is the last chunk, which takes any rows
+                        left at the end of the output
+        input_path      The path of the input file
+        input_range     The start and end of the slab in the input, and the
+                        number of lines before it
+        output_path     The path of the output file
+        output_range    The start and end of the chunk's rows in the output,
+                        and the number of lines before them
+    """
+
+    def __init__(self, index, z, header, last, input_path, input_range,
+                 output_path, output_range):
+        self.index = index
+        self.z = z
+        self.header = header
+        self.last = last
+        self.input_path = input_path
+        self.input_range = input_range
+        self.output_path = output_path
+        self.output_range = output_range
+
+
+def check_chunk(chunk: Chunk) -> int:
+    """
+    Checks a chunk of the output against the same slab of the input, by
+    painting its blocks onto a grid of the cells of the slab.
+
+    Returns the number of blocks in the chunk
+
+    Raises VerificationError for the first error in the chunk, in the order
+    the files are read
+    """
+    x_count, y_count, z_count, parent_size_x, parent_size_y, parent_size_z = \
+        chunk.header
+    z = chunk.z
+    domains = {}
+    limits_f2 = (parent_size_x, parent_size_y, parent_size_z)
+    with open(chunk.input_path, "rb") as file1, \
+            open(chunk.output_path, "rb") as file2:
+        start, end, line_count = chunk.output_range
+        file2.seek(start)
+        rows_f2 = RowReader(file2, line_count, domains, end).read_all()
+        if chunk.index == 0:
+            line_count_f2_last_chunk_end = 0
+        else:
+            line_count_f2_last_chunk_end = line_count + 1
+
+        # Take the rows up to the first from the next chunk, checking each in
+        # the order of the file
+        while True:
+            x2, y2, z2, xs2, ys2, zs2 = rows_f2.values.T
+            errors = rows_f2.bad | (rows_f2.values[:, 3:] < 0).any(axis=1)
+            errors |= (xs2 > parent_size_x) | (ys2 > parent_size_y) | \
+                (zs2 > parent_size_z)
+            errors |= z2 < z
+            errors |= x2 // parent_size_x != (x2 + xs2 - 1) // parent_size_x
+            errors |= y2 // parent_size_y != (y2 + ys2 - 1) // parent_size_y
+            errors |= z2 // parent_size_z != (z2 + zs2 - 1) // parent_size_z
+            errors |= (x2 < 0) | (y2 < 0) | (x2 + xs2 > x_count) | \
+                (y2 + ys2 > y_count)
+            stops = errors | (z2 > z + parent_size_z - 1)
+            i = int(np.argmax(stops)) if stops.any() else len(rows_f2)
+            if i == len(rows_f2) or not errors[i]:
+                break
+            line_count_f2 = int(rows_f2.lines[i])
+            line_f2 = rows_f2.line(i)
+            if rows_f2.bad[i]:
+                rows_f2.repair(i, limits_f2, domains)
+                continue
+            # parse_line() reports any error in the sizes
+            parse_line(line_f2, line_count_f2, *limits_f2)
+            x2, y2, z2, xs2, ys2, zs2 = (int(v) for v in rows_f2.values[i])
             if z2 < z:
                 # This block is from an earlier chunk and we mandate chunkwise
                 # processing => format error.
-                print("{}: {}Error: block z value lies in an earlier chunk, expected before line {}.".format(
+                raise VerificationError(
+                    "{}: {}Error: block z value lies in an earlier chunk, "
+                    "expected before line {}.".format(
+                        line_count_f2,
+                        line_f2,
+                        line_count_f2_last_chunk_end - 1))
+            for axis, index, size, parent_size in zip(
+                    'xyz', (x2, y2, z2), (xs2, ys2, zs2), limits_f2):
+                if index // parent_size != (index + size - 1) // parent_size:
+                    raise VerificationError(
+                        "{}: {}Error: block crosses a parent block boundary "
+                        "in the {} direction.".format(
+                            line_count_f2,
+                            line_f2,
+                            axis))
+            raise VerificationError(
+                "{}: {}Error: block lies outside the model.".format(
                     line_count_f2,
-                    line_f2,
-                    line_count_f2_last_chunk_end - 1),
-                    file=stderr)
-                sys.exit(1)
-            elif x2 // parent_size_x != (x2 + xs2 - 1) // parent_size_x:
-                print("{}: {}Error: block crosses a parent block boundary in the x direction.".format(
-                    line_count_f2,
-                    line_f2),
-                    file=stderr)
-                sys.exit(1)
-            elif y2 // parent_size_y != (y2 + ys2 - 1) // parent_size_y:
-                print("{}: {}Error: block crosses a parent block boundary in the y direction.".format(
-                    line_count_f2,
-                    line_f2),
-                    file=stderr)
-                sys.exit(1)
-            elif z2 // parent_size_z != (z2 + zs2 - 1) // parent_size_z:
-                print("{}: {}Error: block crosses a parent block boundary in the z direction.".format(
-                    line_count_f2,
-                    line_f2),
-                    file=stderr)
-                sys.exit(1)
-            elif z2 > z + parent_size_z - 1:
-                # This block is from the next chunk, so don't process it yet
-                # and assume we have come to the end of the current chunk.
-                line_count_f2_last_chunk_end = line_count_f2
+                    line_f2))
+        # Any rows after the first from the next chunk are left over
+        rows, left_f2 = rows_f2[:i], rows_f2[i:]
+        counts, tags_f2, lines_f2 = paint(
+            rows, z, x_count, y_count, parent_size_z)
+
+        # Now compare it cell by cell with file1 over the slice range z:z+zsf
+        slab_size = x_count * y_count * parent_size_z
+        start, end, line_count = chunk.input_range
+        file1.seek(start)
+        reader_f1 = RowReader(file1, line_count, domains, end)
+        slab = reader_f1.read(slab_size)
+        cells = np.arange(len(slab))
+        expected = np.column_stack((
+            cells % x_count,
+            cells // x_count % y_count,
+            z + cells // (x_count * y_count)))
+        while True:
+            x1, y1, z1 = slab.values[:, :3].T
+            problems = slab.bad | (slab.values[:, 3:] < 0).any(axis=1) | \
+                (slab.values[:, 3:] > 1).any(axis=1)
+            problems |= (slab.values[:, :3] != expected).any(axis=1)
+            problems |= counts[:len(slab)] != 1
+            problems |= tags_f2[:len(slab)] != slab.tags
+            if not problems.any():
                 break
-            # Explode the block into sub-blocks and add each to the chunk list
-            block_count_f2 += 1
-            for sz in range(zs2):
-                for sy in range(ys2):
-                    for sx in range(xs2):
-                        chunk_list.append([x2+sx, y2+sy, z2+sz, domain, line_count_f2])
-            # Now grab the next line and continue the loop
-            line_f2, line_count_f2 = read_next_line_of_input(file2, line_count_f2, stderr)
-            if line_f2 == "":
-                # We have reached the end of the file and now should process
-                # the last chunk.
+            i = int(np.argmax(problems))
+            # parse_and_check_line_of_file1() reports any error in the row of
+            # the input, so the rest are errors in the output
+            slab.set(i, parse_and_check_line_of_file1(
+                *expected[i], slab.line(i), int(slab.lines[i])), domains)
+            if counts[i] != 1:
+                raise VerificationError(
+                    "Error: block {},{},{} missing, duplicated or should "
+                    "appear earlier in the output.".format(
+                        x1[i],
+                        y1[i],
+                        z1[i]))
+            if tags_f2[i] != slab.tags[i]:
+                names = sorted(domains, key=domains.get)
+                raise VerificationError(
+                    "Error: block {},{},{},'{}' on line {} should be "
+                    "'{}'.".format(
+                        x1[i],
+                        y1[i],
+                        z1[i],
+                        names[tags_f2[i]],
+                        lines_f2[i],
+                        names[slab.tags[i]]))
+        if len(slab) < slab_size:
+            # file1 ends inside this chunk
+            i = len(slab)
+            if counts[i:].any():
+                raise VerificationError(
+                    "Error: {} specifies more blocks than {} from line {} "
+                    "onwards.".format(
+                        chunk.output_path,
+                        chunk.input_path,
+                        lines_f2[i:][np.argmax(counts[i:] > 0)]))
+            raise VerificationError(
+                "Error: unexpected end of input on line {}".format(
+                    reader_f1.line_count + 1), 100)
+
+        # The rows left over belong to later chunks, but come before a block
+        # of this chunk or an earlier one
+        while len(left_f2) and not chunk.last:
+            early = left_f2.bad | (left_f2.values[:, 2] < z + parent_size_z)
+            if not early.any():
                 break
-        # Sort the data by x, y and z in that order:
-        chunk_list.sort(key=itemgetter(2, 1, 0))
-        # Now compare it line by line with file1 over the slice range z:z+zsf
-        print("...checking chunk {} of {}".format(
-            z // parent_size_z + 1, z_count // parent_size_z),
-            file=stdvout)
-        for e in chunk_list:
-            line_f1, line_count_f1 = read_next_line_of_input(
-                file1,
-                line_count_f1,
-                stderr)
-            if line_f1 == "":
-                print("Error: {} specifies more blocks than {} from line {} onwards.".format(
-                    file2.name,
-                    file1.name,
-                    e[4]),
-                    file=stderr)
-                sys.exit(1)
-            x1, y1, z1, xs1, ys1, zs1, domain1 = parse_line(
-                line_f1,
-                line_count_f1,
-                1,
-                1,
-                1,
-                stderr)
-            if e[0] != x1 or e[1] != y1 or e[2] != z1:
-                print("Error: block {},{},{} missing, duplicated or should appear earlier in the output.".format(
-                    x1,
-                    y1,
-                    z1),
-                    file=stderr)
-                sys.exit(1)
-            if e[3] != domain1:
-                print("Error: block {},{},{},'{}' on line {} should be '{}'.".format(
-                    x1,
-                    y1,
-                    z1,
-                    e[3],
-                    e[4],
-                    domain1),
-                    file=stderr)
-                sys.exit(1)
+            i = int(np.argmax(early))
+            if left_f2.bad[i]:
+                left_f2.repair(i, limits_f2, domains)
+                continue
+            raise VerificationError(
+                "{}: {}Error: block z value lies in an earlier chunk, "
+                "expected before line {}.".format(
+                    left_f2.lines[i],
+                    left_f2.line(i),
+                    left_f2.lines[0] - 1))
+        if len(left_f2):
+            raise VerificationError(
+                "Error: {} specifies more blocks than {} from line {} "
+                "onwards.".format(
+                    chunk.output_path,
+                    chunk.input_path,
+                    left_f2.lines[0]))
+    return len(rows)
+
+
+def find_slabs(file1: io.IOBase, slab_size: int, count: int,
+               line_count: int):
+    """
+    Finds where each slab of the input starts, by counting its lines from the
+    position of the file, which is after the header.
+
+    Returns a list of the position of each slab, and the number of lines
+    before it. If the file ends early, the missing slabs start at its end.
+    """
+    position = file1.tell()
+    starts = [(position, line_count)]
+    left = slab_size
+    carry = b''
+    while len(starts) < count:
+        data = file1.read(READ_SIZE)
+        if not data:
+            break
+        data = carry + data
+        end = data.rfind(b'\n') + 1
+        data, carry = data[:end], data[end:]
+        lines = data.count(b'\n')
+        if lines < left and not (
+                data.startswith((b'#', b'\n', b'\r')) or b'\n#' in data or
+                b'\n\n' in data or b'\n\r' in data):
+            # every line is a row, and the slab doesn't end here
+            left -= lines
+        else:
+            buffer = np.frombuffer(data, np.uint8)
+            newlines = np.flatnonzero(buffer == ord('\n'))
+            first = buffer[np.concatenate(([0], newlines[:-1] + 1))]
+            rows = np.flatnonzero(
+                (first != ord('#')) & (first != ord('\n')) &
+                (first != ord('\r')))
+            index = left - 1
+            while index < len(rows) and len(starts) < count:
+                starts.append((position + int(newlines[rows[index]]) + 1,
+                               line_count + int(rows[index]) + 1))
+                index += slab_size
+            left = index - len(rows) + 1
+        position += len(data)
+        line_count += lines
+    if carry:
+        position += len(carry)
+        line_count += 1
+    starts.extend([(position, line_count)] * (count - len(starts)))
+    return starts
+
+
+def _line_at(file2: io.IOBase, position: int, end: int):
+    """
+    Finds the first row of the output that starts at or after the position,
+    and before the end.
+
+    Returns a tuple of where the row starts and ends, and its z, or the end
+    and None if there isn't one
+    """
+    if position > 0:
+        # move to the start of the next line, unless it is at one already
+        file2.seek(position - 1)
+        file2.readline()
+    else:
+        file2.seek(0)
+    while file2.tell() < end:
+        start = file2.tell()
+        line = file2.readline()
+        if line[:1] in (b'#', b'\n', b'\r'):
+            continue
+        try:
+            return start, file2.tell(), int(line.split(b',')[2])
+        except (IndexError, ValueError):
+            # left for check_chunk() to report
+            continue
+    return end, end, None
+
+
+def find_chunks(file2: io.IOBase, z_starts: typing.List[int]):
+    """
+    Finds where the rows of each chunk of the output start, with a binary
+    search for the first row at or after the z of each chunk. It relies on
+    the rows being in order of chunk, which check_chunk() checks, so each
+    block still ends up in exactly one chunk when they aren't.
+
+    Returns a list of the position of each chunk, and the number of lines
+    before it, and the size of the file
+    """
+    size = os.fstat(file2.fileno()).st_size
+    positions = [0]
+    for z in z_starts[1:]:
+        low, high = positions[-1], size
+        best = size
+        while low < high:
+            middle = (low + high) // 2
+            start, after, z2 = _line_at(file2, middle, high)
+            if z2 is None:
+                # no row starts between the middle and the high
+                high = middle
+            elif z2 >= z:
+                best = start
+                high = middle
+            else:
+                low = after
+        positions.append(best)
+
+    # count the lines before each chunk
+    starts = []
+    file2.seek(0)
+    position = 0
+    line_count = 0
+    for start in positions:
+        while position < start:
+            data = file2.read(min(READ_SIZE, start - position))
+            line_count += data.count(b'\n')
+            position += len(data)
+        starts.append((start, line_count))
+    return starts, size
+
+
+class Result:
+    """
+    The result of verify(), which is true if the output is equivalent to the
+    input
+
+    Attributes:
+        equivalent      Whether the output is equivalent to the input
+        input_blocks    The number of blocks in the input, or None if its
+                        header couldn't be read
+        output_blocks   The number of blocks in the output, or None if it
+                        isn't equivalent
+        chunks          The number of chunks checked
+        error           The diagnostic of the first error, or None
+        status          The exit status of the script: 0 if the output is
+                        equivalent, otherwise that of the VerificationError
+    """
+
+    def __init__(self, input_blocks=None, output_blocks=None, chunks=0,
+                 error=None):
+        self.equivalent = error is None
+        self.input_blocks = input_blocks
+        self.output_blocks = output_blocks
+        self.chunks = chunks
+        self.error = None if error is None else error.message
+        self.status = 0 if error is None else error.status
+
+    def __bool__(self):
+        return self.equivalent
+
+    def __repr__(self):
+        return "Result(equivalent={}, input_blocks={}, output_blocks={}, " \
+               "error={!r})".format(self.equivalent, self.input_blocks,
+                                    self.output_blocks, self.error)
+
+    @property
+    def compression(self):
+        """The fraction of the blocks removed, or None if not equivalent"""
+        if not self.equivalent or not self.input_blocks:
+            return None
+        return (self.input_blocks - self.output_blocks) / self.input_blocks
+
+
+def verify(input_path: str, output_path: str, max_workers: int = None,
+           progress: typing.Callable[[str], None] = None) -> Result:
+    """
+    Verifies that an output file is equivalent to the block model in an input
+    file. The model is split into chunks in z, one per parent block, which are
+    checked at once in separate processes.
+
+    Parameters:
+        input_path      The path of the input block model CSV file
+        output_path     The path of the output CSV file
+        max_workers     The number of processes to check the chunks in. It
+                        defaults to the number of CPUs, and 1 checks them in
+                        this process
+        progress        A function to call with each progress message
+
+    Returns the Result, with the first error found if any
+    """
+    report = progress or (lambda message: None)
+    input_blocks = None
+    chunks = []
+    try:
+        with open(input_path, "rb") as file1, open(output_path, "rb") as file2:
+            header = tuple(get_header_info_of_file1(file1, 1))
+            x_count, y_count, z_count, _, _, parent_size_z = header
+            input_blocks = x_count * y_count * z_count
+            report("...looking for {} blocks.".format(input_blocks))
+
+            # The output must have at least 1 row
+            line_count_f2 = 0
+            while True:
+                line_f2 = file2.readline()
+                line_count_f2 += 1
+                if not line_f2:
+                    raise VerificationError(
+                        "Error: unexpected end of input on line {}".format(
+                            line_count_f2), 100)
+                if line_f2[:1] not in (b'#', b'\n', b'\r'):
+                    break
+
+            z_starts = list(range(0, z_count, parent_size_z))
+            slab_starts = find_slabs(file1, x_count * y_count * parent_size_z,
+                                     len(z_starts), 1)
+            chunk_starts, output_size = find_chunks(file2, z_starts)
+        for index, z in enumerate(z_starts):
+            last = index == len(z_starts) - 1
+            slab_end = None if last else slab_starts[index + 1][0]
+            chunk_end = output_size if last else chunk_starts[index + 1][0]
+            chunks.append(Chunk(
+                index, z, header, last,
+                input_path, (slab_starts[index][0], slab_end,
+                             slab_starts[index][1]),
+                output_path, (chunk_starts[index][0], chunk_end,
+                              chunk_starts[index][1])))
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        output_blocks = 0
+        if max_workers <= 1 or len(chunks) <= 1:
+            results = map(check_chunk, chunks)
+            for chunk, blocks in zip(chunks, results):
+                output_blocks += blocks
+                report("...checked chunk {} of {}".format(
+                    chunk.index + 1, len(chunks)))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers) as pool:
+                futures = [pool.submit(check_chunk, chunk) for chunk in chunks]
+                try:
+                    # the first error is from the earliest chunk
+                    for chunk, future in zip(chunks, futures):
+                        output_blocks += future.result()
+                        report("...checked chunk {} of {}".format(
+                            chunk.index + 1, len(chunks)))
+                except VerificationError:
+                    pool.shutdown(cancel_futures=True)
+                    raise
+    except VerificationError as error:
+        return Result(input_blocks, None, len(chunks), error)
+    except OSError as err:
+        return Result(input_blocks, None, len(chunks), VerificationError(
+            "Error: {}".format(err), 200))
+    return Result(input_blocks, output_blocks, len(chunks))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Checks that a compressed block model is equivalent to "
+                    "the block model it was compressed from. The exit status "
+                    "is 0 if it is, otherwise the first error is printed to "
+                    "STDERR"
+    )
+    parser.add_argument(
+        "input",
+        help="the input block model CSV file"
+    )
+    parser.add_argument(
+        "output",
+        help="the compressed CSV file to check"
+    )
+    parser.add_argument(
+        "--workers",
+        help="the number of processes to check the chunks of the model in "
+             "(default: the number of CPUs)",
+        type=int
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stdvout = sys.stderr
+    result = verify(args.input, args.output, args.workers,
+                    lambda message: print(message, file=stdvout))
+    if not result:
+        print(result.error, file=sys.stderr)
+        sys.exit(result.status)
     print("...equivalence = 100%", file=stdvout)
-    print("-----------", file=stdvout)
\ No newline at end of file
+    print("-----------", file=stdvout)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""
+Measures the peak memory of a process, for the runner and the compressor's
+benchmark. It only imports the standard library, so it can be imported before
+the processes it measures are started without adding to their peak, which
+includes the memory of the parent process when they were started.
+"""
+
+import os
+import sys
+
+
+def wait(process):
+    """
+    Waits for a process started with subprocess.Popen, and sets its
+    returncode.
+
+    Returns the peak resident memory of the process, or of its largest child,
+    in megabytes
+    """
+    # the resource usage of just this process, and the children it waited
+    # for, rather than of every child, like getrusage() gives
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    # the peak memory is in kilobytes, except on macOS where it is in bytes
+    peak = usage.ru_maxrss / 1024
+    if sys.platform == "darwin":
+        peak /= 1024
+    return peak
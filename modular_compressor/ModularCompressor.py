@@ -1,29 +1,152 @@
 #!/usr/bin/env python3
 
+import argparse
 from model import Model
 from csvparser import CSVParser
 import compressionEngine
+from deadline import Deadline, duration
+import instrumentation
+import profiling
+import tracing
+import pipeline
+import sys
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compresses the block model on STDIN and writes the "
+                    "compressed block model to STDOUT"
+    )
+    parser.add_argument(
+        "--sequential",
+        help="read, compress and write each slice in turn, instead of as a "
+             "pipeline",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--level",
+        help="the compression level, from 0 for the fastest to 9 for the "
+             "fewest blocks (default: %(default)s). 0 only compresses parent "
+             "blocks with 1 domain, 1 to 3 find runs and octants, 4 and 5 "
+             "use greedy expansion, and 6 to 9 keep the best of more and more "
+             "exhaustive searches, which are slower. 8 and 9 can spend up to "
+             "1 and 2 seconds on each parent block with more than 1 domain. "
+             "--time-budget lowers the level when the run falls behind",
+        type=int,
+        choices=range(10),
+        metavar="{0..9}",
+        default=compressionEngine.DEFAULT_LEVEL
+    )
+    parser.add_argument(
+        "--time-budget",
+        help="the time to compress the whole model in, e.g. 90s, 5m or 1h. "
+             "The level of each slice is lowered when the compression falls "
+             "behind, and raised again up to --level when it is ahead",
+        type=duration,
+        metavar="DURATION"
+    )
+    parser.add_argument(
+        "--stats",
+        help="record the time spent in each stage and compressor, and write "
+             "a summary as JSON to the file, or to STDERR if no file is given",
+        nargs="?",
+        const="-",
+        metavar="FILE"
+    )
+    parser.add_argument(
+        "--trace",
+        help="record a timeline of the reads, batches, compressor calls and "
+             "writes of every process, and save it to the file in the trace "
+             "event format of Perfetto and chrome://tracing",
+        metavar="FILE"
+    )
+    parser.add_argument(
+        "--profile",
+        help="profile the main process and every worker, and save the merged "
+             "profile to the file, which pstats can read",
+        metavar="FILE"
+    )
+    parser.add_argument(
+        "--profiler",
+        help="the profiler used by --profile, cProfile or a statistical "
+             "sampler, which costs less on long runs (default: %(default)s)",
+        choices=profiling.KINDS,
+        default="cprofile"
+    )
+    return parser.parse_args()
+
+
+def write_stats(path):
+    """Writes the summary of the instrumentation to the file, or STDERR"""
+    if path == "-":
+        instrumentation.report(sys.stderr)
+    else:
+        with open(path, "w") as out_file:
+            instrumentation.report(out_file)
 
 
 def main():
+    args = parse_args()
+    if args.stats is not None:
+        instrumentation.enable()
+    profiler = None
+    if args.profile is not None:
+        profiler = profiling.Profiler(args.profile, args.profiler)
+    try:
+        compress(args, profiler)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+        tracing.stop()
+        if args.stats is not None:
+            write_stats(args.stats)
+
+
+def compress(args, profiler=None):
     # Create an empty Model
     model = Model()
 
-    # create a CSV Parser
-    parser = CSVParser(model)
-
-    # Loop over all the slices of input data, compress, and write to the output
-    while True:
-        # Read the next slice of blocks
-        num_blocks = parser.read()
-        if num_blocks == 0:
-            break
-        
-        # compress them
-        compressionEngine.run(model)
-        
-        # write out this slice before moving on to the next slice
-        parser.write()
+    # create a CSV Parser, which parses each slice in bulk into shared memory
+    parser = CSVParser(model, bulk=True, shared=True)
+
+    # the engine's worker processes are used for all of the slices
+    engine = compressionEngine.CompressionEngine(
+        level=args.level,
+        profile=None if profiler is None else profiler.worker_args)
+    with engine:
+        if profiler is not None:
+            # started once the workers have been forked, so they only
+            # profile themselves
+            profiler.start()
+
+        if args.trace is not None:
+            # started once the workers have been forked, so they don't share
+            # the trace file
+            tracing.start(args.trace)
+
+        if args.time_budget is not None:
+            # pick the level of each slice to finish within the budget
+            engine = Deadline.for_parser(
+                engine, parser, args.time_budget, args.level)
+
+        if not args.sequential:
+            # read the next slice and write the last slice while compressing
+            pipeline.run(parser, engine.compress)
+            return
+
+        # Loop over all the slices of input data, compress, and write to the
+        # output
+        while True:
+            # Read the next slice of blocks
+            num_blocks = parser.read()
+            if num_blocks == 0:
+                break
+
+            # compress them
+            engine.run(model)
+
+            # write out this slice before moving on to the next slice
+            parser.write()
 
 
 if __name__ == '__main__':
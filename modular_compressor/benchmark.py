@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+A module for benchmarking the compressor end to end. Each dataset is
+compressed by ModularCompressor.main in its own process, the same way it is
+run for real, and the time taken, the compression and the peak memory of the
+process and its workers are recorded. The results are saved as JSON, along
+with the version of the code, so they can be compared from one version to the
+next.
+
+The datasets are either CSV files, or synthetic models from the suite, which
+are made with the generator module.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shlex
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import generator
+
+# the directory of the compressor
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# the peak memory is measured the same way as the runner does, with the
+# module in the Code directory
+sys.path.insert(0, os.path.join(HERE, os.pardir, 'Code'))
+import process_usage  # noqa: E402
+
+# the synthetic datasets, by name, as the kind of model, its size and the
+# parent block size. The sizes are multiplied by the scale of the benchmark
+SUITE = {
+    'stratal': ('stratal', (64, 64, 40), (8, 8, 5)),
+    'ore': ('ore', (64, 64, 40), (8, 8, 5)),
+    'realistic': ('realistic', (64, 64, 40), (8, 8, 5)),
+    'noise': ('noise', (32, 32, 20), (8, 8, 5)),
+    'checkerboard': ('checkerboard', (32, 32, 20), (8, 8, 5)),
+}
+
+
+def _version():
+    """Gets the git commit of the code, or None if it isn't known"""
+    try:
+        completed = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True,
+            text=True)
+    except OSError:
+        return None
+    if completed.returncode != 0:
+        return None
+    return completed.stdout.strip()
+
+
+def read_header(path):
+    """
+    Reads the header of a block model file.
+    
+    Returns a tuple of the model size and the parent block size, each as a
+    list of x, y and z
+    """
+    with open(path) as file:
+        header = file.readline()
+    numbers = [int(n) for n in header.lstrip('#').split(',')]
+    return numbers[0:3], numbers[3:6]
+
+
+def count_blocks(path):
+    """Counts the blocks in a block model file, which has a header line"""
+    with open(path, 'rb') as file:
+        return sum(chunk.count(b'\n') for chunk in iter(
+            lambda: file.read(1 << 20), b'')) - 1
+
+
+def make_dataset(name, directory, scale=1, seed=0):
+    """
+    Generates a dataset of the suite in the directory, unless it is already
+    there.
+    
+    Returns the path of the dataset's file
+    """
+    kind, size, parent_block_size = SUITE[name]
+    size = [n * scale for n in size]
+    path = os.path.join(directory, '{}_{}x{}x{}_seed{}.csv'.format(
+        name, size[0], size[1], size[2], seed))
+    if not os.path.exists(path):
+        partial = path + '.partial'
+        with open(partial, 'w', newline='') as out_file:
+            generator.generate(kind, size, parent_block_size, out_file, seed)
+        os.replace(partial, path)
+    return path
+
+
+def run_compressor(in_path, out_path, compressor_args=()):
+    """
+    Compresses a block model file with ModularCompressor.py, in a new
+    process.
+    
+    Returns a tuple of the wall time in seconds, and the peak resident memory
+    of the process, or of its largest worker, in megabytes
+    
+    Raises RuntimeError if the compressor fails
+    """
+    command = [sys.executable, os.path.join(HERE, 'ModularCompressor.py')]
+    command.extend(compressor_args)
+    with open(in_path, 'rb') as in_file, open(out_path, 'wb') as out_file:
+        started = time.perf_counter()
+        process = subprocess.Popen(
+            command, stdin=in_file, stdout=out_file, stderr=subprocess.PIPE,
+            cwd=HERE)
+        errors = process.stderr.read()
+        peak = process_usage.wait(process)
+        seconds = time.perf_counter() - started
+        process.stderr.close()
+    
+    if process.returncode != 0:
+        raise RuntimeError("the compressor failed on {}, exit status {}:\n"
+                           "{}".format(in_path, process.returncode,
+                                       errors.decode(errors='replace')))
+    return seconds, peak
+
+
+def benchmark(name, path, compressor_args=(), repeat=1, out_dir=None):
+    """
+    Benchmarks the compressor on a dataset, compressing it repeat times.
+    
+    Returns a dict of the results, with the median time of the runs
+    """
+    size, parent_block_size = read_header(path)
+    in_blocks = size[0] * size[1] * size[2]
+    out_path = os.path.join(out_dir or tempfile.gettempdir(),
+                            '{}.{}.out.csv'.format(name, os.getpid()))
+    
+    times = []
+    peaks = []
+    try:
+        for _ in range(repeat):
+            seconds, peak = run_compressor(path, out_path, compressor_args)
+            times.append(seconds)
+            peaks.append(peak)
+        out_blocks = count_blocks(out_path)
+    finally:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+    
+    seconds = statistics.median(times)
+    return {
+        'name': name,
+        'path': os.path.abspath(path),
+        'size': size,
+        'parent_block_size': parent_block_size,
+        'input_blocks': in_blocks,
+        'output_blocks': out_blocks,
+        'compression': (in_blocks - out_blocks) / in_blocks,
+        # None when the compressor writes no blocks
+        'ratio': in_blocks / out_blocks if out_blocks else None,
+        'seconds': seconds,
+        'times': times,
+        'blocks_per_second': in_blocks / seconds,
+        'peak_rss_mb': max(peaks),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks ModularCompressor.py on the synthetic "
+                    "datasets of the suite and any block model files, and "
+                    "writes the results as JSON"
+    )
+    parser.add_argument(
+        "files",
+        help="block model CSV files to benchmark, as well as the suite",
+        nargs="*"
+    )
+    parser.add_argument(
+        "--suite",
+        help="the synthetic datasets to benchmark (default: all of them, "
+             "unless files are given)",
+        choices=sorted(SUITE),
+        nargs="*"
+    )
+    parser.add_argument(
+        "--scale",
+        help="multiplies the size of the synthetic datasets in every "
+             "direction (default: %(default)s)",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--seed",
+        help="the seed of the synthetic datasets (default: %(default)s)",
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        "--repeat",
+        help="the number of times to compress each dataset, taking the "
+             "median time (default: %(default)s)",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--compressor-args",
+        help="the arguments to run ModularCompressor.py with, e.g. "
+             "\"--level 9\"",
+        default=""
+    )
+    parser.add_argument(
+        "--data-dir",
+        help="the directory to keep the synthetic datasets in, so they are "
+             "only generated once (default: a temporary directory)"
+    )
+    parser.add_argument(
+        "--output",
+        help="the file to write the JSON results to (default: STDOUT)"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.suite is None:
+        args.suite = [] if args.files else sorted(SUITE)
+    compressor_args = shlex.split(args.compressor_args)
+    
+    report = {
+        'version': _version(),
+        'started': datetime.datetime.now().astimezone().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'compressor_args': compressor_args,
+        'scale': args.scale,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': [],
+    }
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        data_dir = args.data_dir or tmpdir
+        os.makedirs(data_dir, exist_ok=True)
+        
+        datasets = [(name, None) for name in args.suite]
+        datasets.extend(
+            (os.path.splitext(os.path.basename(path))[0], path)
+            for path in args.files)
+        for name, path in datasets:
+            if path is None:
+                print("generating {}...".format(name), file=sys.stderr)
+                path = make_dataset(name, data_dir, args.scale, args.seed)
+            print("compressing {}...".format(name), file=sys.stderr)
+            result = benchmark(
+                name, path, compressor_args, args.repeat, tmpdir)
+            print("...{:.3f}s, {:.0f} blocks/s, {:.2f}% compression, "
+                  "{:.0f}MB".format(
+                      result['seconds'], result['blocks_per_second'],
+                      result['compression'] * 100, result['peak_rss_mb']),
+                  file=sys.stderr)
+            report['results'].append(result)
+    
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
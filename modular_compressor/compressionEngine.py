@@ -1,7 +1,20 @@
 from concurrent.futures import ProcessPoolExecutor
 import multiprocessing
+import numpy as np
+from model import ArrayParentBlock
+import instrumentation
+import profiling
+import tracing
+import patterncache
+import scheduler
+import sharedslab
 from compressors import sameDomain
+from compressors import RunLength
 from compressors import GreedyExpander
+from compressors import MaximalCuboid
+from compressors import OptimalPartitioner
+from compressors import Octree
+from compressors.compressor import lower_bound
 
 """
 The module which is responsible for compressing the model. Which compression
@@ -14,7 +27,65 @@ of the parent blocks across multiple processors.
 
 # Create all the different types of compressors
 same_domain_compressor = sameDomain.SameDomain()
-greedy_expander = GreedyExpander.GreedyExpander()
+
+# the compressors which can be tried on the parent blocks with more than 1
+# domain, by the name of the strategy
+STRATEGIES = {
+    'run_length_x': RunLength.RunLength(dimension='x'),
+    'run_length_y': RunLength.RunLength(dimension='y'),
+    'run_length_z': RunLength.RunLength(dimension='z'),
+    'greedy': GreedyExpander.GreedyExpander(),
+    'cuboid': MaximalCuboid.MaximalCuboid(),
+    'octree': Octree.Octree(),
+    'optimal': OptimalPartitioner.OptimalPartitioner(),
+    # the deeper searches have a time limit for each parent block, as the
+    # number of boxes grows with the square of the number of cells
+    'optimal_deep': OptimalPartitioner.OptimalPartitioner(
+        max_cells=512, max_nodes=50000, time_limit=1.0),
+    'optimal_exhaustive': OptimalPartitioner.OptimalPartitioner(
+        max_cells=4096, max_nodes=100000, time_limit=2.0),
+}
+
+_RUN_LENGTHS = ('run_length_x', 'run_length_y', 'run_length_z')
+
+# the strategies for each compression level, from the fastest to the best
+# ratio. In each chain the cheap strategies go first, so the expensive ones
+# can be skipped if they can't beat them
+LEVELS = {
+    # only parent blocks with 1 domain are compressed
+    0: (),
+    1: ('run_length_x',),
+    2: _RUN_LENGTHS,
+    3: _RUN_LENGTHS + ('octree',),
+    4: ('greedy',),
+    5: _RUN_LENGTHS + ('greedy',),
+    6: _RUN_LENGTHS + ('greedy', 'cuboid', 'optimal'),
+    7: _RUN_LENGTHS + ('greedy', 'cuboid', 'octree', 'optimal'),
+    8: _RUN_LENGTHS + ('greedy', 'cuboid', 'octree', 'optimal_deep'),
+    9: _RUN_LENGTHS + ('greedy', 'cuboid', 'octree', 'optimal_exhaustive'),
+}
+
+# the optimal search of level 6 finds only a few fewer blocks than greedy
+# expansion, at several times the cost, so it has to be asked for
+DEFAULT_LEVEL = 5
+
+# the strategies tried by default, in order
+DEFAULT_STRATEGIES = LEVELS[DEFAULT_LEVEL]
+
+# the compressors tried in this process, see configure()
+strategies = [STRATEGIES[name] for name in DEFAULT_STRATEGIES]
+
+# the names of the strategies in use in this process
+strategy_names = DEFAULT_STRATEGIES
+
+# the compressed blocks of the patterns of domains seen by this process. Each
+# worker has its own cache, which it keeps for the whole run
+pattern_cache = patterncache.PatternCache()
+
+# the pattern cache of each chain of strategies used by this process, by
+# their names, so a chain keeps its cache when another chain is used for a
+# while
+pattern_caches = {DEFAULT_STRATEGIES: pattern_cache}
 
 try:
     num_cpus = multiprocessing.cpu_count()
@@ -22,32 +93,428 @@ except NotImplementedError:
     num_cpus = 4
 
 
+def _strategy_compressors(strategy_names):
+    """
+    Gets the compressors of the strategies with the names.
+    
+    Raises ValueError if a name is unknown
+    """
+    unknown = [name for name in strategy_names if name not in STRATEGIES]
+    if unknown:
+        raise ValueError(
+            "unknown compression strategies: {}".format(", ".join(unknown)))
+    return [STRATEGIES[name] for name in strategy_names]
+
+
+def level_strategies(level):
+    """
+    Gets the names of the strategies for a compression level, from 0 for the
+    fastest to 9 for the fewest blocks. See LEVELS.
+    
+    Raises ValueError if there is no such level
+    """
+    try:
+        return LEVELS[level]
+    except KeyError:
+        raise ValueError(
+            "the compression level must be from 0 to 9, not {!r}".format(
+                level)) from None
+
+
+def configure(strategy_names=None):
+    """
+    Sets the strategies tried on the parent blocks in this process, as a list
+    of names from STRATEGIES in the order to try them. None sets the default
+    strategies. With no strategies, parent blocks with more than 1 domain are
+    left as they are. The pattern cache is emptied, because the blocks in it
+    were found with the old strategies.
+    
+    Raises ValueError if a name is unknown
+    """
+    pattern_caches.clear()
+    use_strategies(strategy_names)
+
+
+def use_strategies(names=None):
+    """
+    Switches the strategies tried on the parent blocks in this process, like
+    configure(), but keeps the pattern cache of each chain of strategies, so
+    switching back to a chain reuses its cache. It does nothing if the
+    strategies are already in use.
+    
+    Raises ValueError if a name is unknown
+    """
+    global strategies, strategy_names, pattern_cache
+    names = DEFAULT_STRATEGIES if names is None else tuple(names)
+    if names == strategy_names and names in pattern_caches:
+        return
+    strategies = _strategy_compressors(names)
+    strategy_names = names
+    pattern_cache = pattern_caches.setdefault(
+        names, patterncache.PatternCache())
+
+
 def compress_parent_block(parentblock):
     """
     Decides which compression algorithms to run on which parent blocks.
-    The algorithms used can vary between parent blocks, so some heuristic should
-    be put in place to decide which algorithms to use.
+    Parent blocks with 1 domain become a single block, and the rest are
+    compressed with the strategies, see compress_blocks().
     
     Returns the newly compressed parent block
     """
-    pb = same_domain_compressor.compress(parentblock)
+    with instrumentation.stage('compressor.same_domain'), \
+            tracing.span('compressor.same_domain',
+                         slab=_traced_slab(parentblock)):
+        pb = same_domain_compressor.compress(parentblock)
     
-    if len(pb) > 2:
-        pb = greedy_expander.compress(pb)
+    if len(pb) > 2 and strategies:
+        # parent blocks with the same pattern of domains as one compressed
+        # before reuse its blocks
+        pb = pattern_cache.compress(pb, compress_blocks)
     
     return pb
 
 
-def run(model):
+def compress_blocks(pb):
     """
-    Run the appropriate compressors on the model using multiprocessing
+    Compresses a parent block with more than 1 domain. Each of the strategies
+    partitions the parent block in turn, and the partition with the fewest
+    blocks is kept. The strategies stop once a partition has as few blocks as
+    the lower bound, because none can do better. A strategy is skipped when
+    its estimate shows it can't beat the best partition so far.
+    
+    When instrumentation is enabled, the time of each strategy is recorded
+    as the stage "compressor.<name>", with counters of its calls, the blocks
+    in and out, and how often it was skipped, ran out of budget or won. When
+    tracing is enabled, each call is a span with the same name.
+    
+    Returns the compressed parent block
     """
-    chunk_size = (len(model) + 1) // num_cpus
-    new_parents = []
-    with ProcessPoolExecutor(max_workers=num_cpus) as executor:
-        new_parents.extend(
-            executor.map(
-                compress_parent_block, model.parent_blocks, chunksize=chunk_size
+    tags = pb.tag_grid()
+    least = lower_bound(tags)
+    best = None
+    best_name = None
+    fewest = len(pb)
+    blocks_in = fewest
+    slab = _traced_slab(pb)
+    for name, compressor in zip(strategy_names, strategies):
+        if fewest <= least:
+            break
+        if compressor.estimate(tags) >= fewest:
+            instrumentation.count('compressor.' + name + '.skipped')
+            continue
+        with instrumentation.stage('compressor.' + name), \
+                tracing.span('compressor.' + name, slab=slab):
+            blocks = compressor.partition(tags, fewest)
+        if getattr(compressor, 'exhausted', False):
+            instrumentation.count('compressor.' + name + '.out_of_budget')
+        if instrumentation.enabled and blocks is not None:
+            instrumentation.count('compressor.' + name + '.blocks_in',
+                                  blocks_in)
+            instrumentation.count('compressor.' + name + '.blocks_out',
+                                  len(blocks[2]))
+        if blocks is not None and len(blocks[2]) < fewest:
+            best = blocks
+            best_name = name
+            fewest = len(blocks[2])
+    
+    if best is not None:
+        instrumentation.count('compressor.' + best_name + '.wins')
+        pb.set_blocks(*best)
+    return pb
+
+
+def _traced_slab(pb):
+    """Gets the index of the slice of a parent block, if tracing"""
+    return tracing.slab_index(pb) if tracing.enabled else None
+
+
+def run_observed(recorded, traced, function, *args):
+    """
+    Runs a function in a worker, recording its stages (see instrumentation)
+    if recorded is True, and its spans (see tracing) if traced is True, as a
+    span named "batch".
+    
+    Returns a tuple of the function's result, the stages recorded or None,
+    and the spans recorded or None
+    """
+    if traced:
+        tracing.start_worker()
+        tasks = args[0]
+        first = tasks[0]
+        if isinstance(first, tuple):
+            # a shared task of the slab, size and position of a parent block
+            slab = first[2].z // first[1].z
+        else:
+            slab = tracing.slab_index(first)
+        with tracing.span('batch', slab=slab, parent_blocks=len(tasks)):
+            result, stages = _run_recorded(recorded, function, *args)
+        return result, stages, tracing.take()
+    result, stages = _run_recorded(recorded, function, *args)
+    return result, stages, None
+
+
+def _run_recorded(recorded, function, *args):
+    """Runs a function, recording its stages if recorded is True"""
+    if recorded:
+        return instrumentation.run_recorded(function, *args)
+    return function(*args), None
+
+
+def compress_shared_parent_block(task):
+    """
+    Compresses a parent block, which is read from the SharedSlab of its slice.
+    The task is a tuple of the slab, and the size and position of the parent
+    block.
+    
+    Returns the compressed blocks as a (7, n) array, with rows for the x, y
+    and z position, the x, y and z size and the domain tag of the blocks
+    """
+    slab, size, position = task
+    parentblock = ArrayParentBlock.from_tags(
+        size, position, slab.parent_block_tags(size, position), copy=False)
+    pb = compress_parent_block(parentblock)
+    positions, sizes, tags = pb.block_arrays()
+    return np.vstack((positions, sizes, tags)).astype(
+        np.promote_types(np.uint16, tags.dtype))
+
+
+def compress_batch(parent_blocks, strategy_names=None):
+    """
+    Compresses a batch of parent blocks in a worker, with the strategies
+    named, or those the worker was configured with if they're None.
+    
+    Returns the list of compressed parent blocks
+    """
+    if strategy_names is not None:
+        use_strategies(strategy_names)
+    return [compress_parent_block(pb) for pb in parent_blocks]
+
+
+def compress_shared_batch(tasks, strategy_names=None):
+    """
+    Compresses a batch of parent blocks in a worker, reading them from their
+    SharedSlab. See compress_shared_parent_block() and compress_batch().
+    
+    Returns the list of arrays of the compressed blocks
+    """
+    if strategy_names is not None:
+        use_strategies(strategy_names)
+    return [compress_shared_parent_block(task) for task in tasks]
+
+
+def _start_worker(strategy_names, profile):
+    """
+    Run by each worker as it starts, to configure its strategies and, if
+    profile isn't None, to start profiling it with those arguments of
+    profiling.start_worker()
+    """
+    configure(strategy_names)
+    if profile is not None:
+        profiling.start_worker(*profile)
+
+
+def _warm_up():
+    """Run by each worker when the engine starts, to start the processes"""
+    return None
+
+
+class CompressionEngine:
+    """
+    Compresses the parent blocks using a pool of worker processes, which is
+    kept for the whole run rather than being created for each slice. The
+    workers keep their compressors, and anything the compressors have cached,
+    from one slice to the next.
+    
+    The engine should be used as a context manager, so the workers are shut
+    down at the end of the run or when there is an error, e.g.
+        with CompressionEngine() as engine:
+            engine.run(model)
+    
+    Parameters:
+        max_workers     The number of worker processes. It defaults to the
+                        number of cpus
+        strategies      The names of the strategies the workers try on each
+                        parent block, see configure()
+        level           The compression level, from 0 to 9, which picks the
+                        strategies if they aren't given. See LEVELS. It
+                        defaults to DEFAULT_LEVEL
+        profile         The arguments of profiling.start_worker(), such as
+                        the worker_args of a profiling.Profiler, to profile
+                        the workers, or None
+    """
+    
+    def __init__(self, max_workers=None, strategies=None, level=None,
+                 profile=None):
+        super(CompressionEngine, self).__init__()
+        self.max_workers = max_workers or num_cpus
+        if strategies is None:
+            strategies = level_strategies(
+                DEFAULT_LEVEL if level is None else level)
+        
+        # find any unknown names now, rather than in the workers
+        _strategy_compressors(strategies)
+        self.strategies = tuple(strategies)
+        self.profile = profile
+        self.executor = None
+        
+    def start(self):
+        """
+        Starts the worker processes. This is best done before starting any
+        other threads, because the workers are forked from this process.
+        """
+        if self.executor is None:
+            sharedslab.prepare_workers()
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                initializer=_start_worker,
+                initargs=(self.strategies, self.profile)
             )
-        )
-        model.parent_blocks = new_parents
+            self.executor.submit(_warm_up).result()
+        return self
+    
+    def shutdown(self, cancel=False):
+        """
+        Shuts down the worker processes. If cancel is True, any parent blocks
+        waiting to be compressed are abandoned.
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=cancel)
+            self.executor = None
+            
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(cancel=exc_type is not None)
+        return False
+    
+    def run(self, model, level=None):
+        """
+        Run the appropriate compressors on the model using the workers, see
+        compress()
+        """
+        model.parent_blocks = self.compress(model.parent_blocks, level)
+        
+    @instrumentation.timed('engine.compress')
+    @tracing.traced('compress', lambda self, parent_blocks, level=None: {
+        'slab': tracing.slab_index(parent_blocks[0]) if parent_blocks
+        else None, 'level': level})
+    def compress(self, parent_blocks, level=None):
+        """
+        Run the appropriate compressors on a list of parent blocks using the
+        workers. Parent blocks that are already a single block are skipped.
+        The parent blocks with only 1 domain are compressed in this
+        process, and the rest are sent to the workers in batches planned by
+        the scheduler, starting with the most expensive.
+        
+        The parent blocks are compressed with the engine's strategies, or
+        with those of the compression level if it is given (see LEVELS).
+        
+        Parent blocks read into a SharedSlab hold views of it, so the slab is
+        only released if the compression fails. Otherwise it's released when
+        the slice is written, see CSVParser.write_slice().
+        
+        Returns the list of compressed parent blocks
+        """
+        parent_blocks = list(parent_blocks)
+        names = None if level is None else level_strategies(level)
+        
+        # a parent block that is a single block is already compressed, such
+        # as those the parser found to have only 1 domain
+        pending = [i for i, pb in enumerate(parent_blocks) if len(pb) > 1]
+        if not pending:
+            return parent_blocks
+        
+        self.start()
+        shared = all(
+            getattr(parent_blocks[i], 'slab', None) is not None
+            for i in pending)
+        
+        # the workers record their stages and spans along with their
+        # results, to be merged with those of this process
+        observed = (instrumentation.enabled, tracing.enabled)
+        
+        try:
+            local, batches = scheduler.plan(
+                [parent_blocks[i] for i in pending], self.max_workers)
+            local = [pending[i] for i in local]
+            batches = [[pending[i] for i in batch] for batch in batches]
+            
+            with instrumentation.stage('engine.submit'):
+                if shared:
+                    futures = [self._submit(
+                        observed, compress_shared_batch,
+                        [(parent_blocks[i].slab, parent_blocks[i].size,
+                          parent_blocks[i].position) for i in batch],
+                        names
+                    ) for batch in batches]
+                else:
+                    futures = [self._submit(
+                        observed, compress_batch,
+                        [parent_blocks[i] for i in batch], names
+                    ) for batch in batches]
+            
+            # while the workers are busy, compress the cheap ones here
+            with instrumentation.stage('engine.local'):
+                for i in local:
+                    parent_blocks[i] = same_domain_compressor.compress(
+                        parent_blocks[i])
+                
+            for batch, future in zip(batches, futures):
+                with instrumentation.stage('engine.wait'), \
+                        tracing.span('wait', slab=_traced_slab(
+                            parent_blocks[batch[0]])):
+                    results = future.result()
+                if any(observed):
+                    results, stages, spans = results
+                    if stages is not None:
+                        instrumentation.merge(stages)
+                    if spans is not None:
+                        tracing.add(spans)
+                for i, result in zip(batch, results):
+                    if shared:
+                        parent_blocks[i].set_blocks(
+                            result[0:3], result[3:6], result[6])
+                    else:
+                        parent_blocks[i] = result
+        except BaseException:
+            # the slice won't be written, so its slabs are released now
+            if shared:
+                sharedslab.release_slabs(parent_blocks)
+            raise
+        return parent_blocks
+    
+    def _submit(self, observed, function, *args):
+        """
+        Submits a function to the workers. If either of the observed pair of
+        whether to record the stages and the spans is True, the function is
+        run with run_observed().
+        
+        Returns the future of the function's result
+        """
+        if any(observed):
+            return self.executor.submit(
+                run_observed, *observed, function, *args)
+        return self.executor.submit(function, *args)
+
+
+def run(model, level=None):
+    """
+    Run the appropriate compressors on the model using multiprocessing, at
+    the compression level (see LEVELS)
+    """
+    model.parent_blocks = compress(model.parent_blocks, level)
+    
+    
+def compress(parent_blocks, level=None):
+    """
+    Run the appropriate compressors on a list of parent blocks using
+    multiprocessing, at the compression level (see LEVELS). The worker
+    processes only last for this call, so a CompressionEngine should be used
+    when compressing more than 1 slice.
+    
+    Returns the list of compressed parent blocks
+    """
+    with CompressionEngine(level=level) as engine:
+        return engine.compress(parent_blocks)
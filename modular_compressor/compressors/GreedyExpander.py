@@ -1,5 +1,23 @@
 from compressors.compressor import Compressor
-from model import Direction
+from model import ArrayParentBlock, Block, Direction, Position, Size
+import numpy as np
+
+# the label of a cell which is already part of a block
+COVERED = 255
+
+# rows of covered labels, for marking cells as covered without building a new
+# bytes object for every merge. It grows to the longest row seen, see
+# _covered_rows()
+COVERED_ROWS = [bytes([COVERED]) * n for n in range(256)]
+
+# the labels as bytes objects, for counting them with bytearray.count()
+LABEL_BYTES = [bytes([label]) for label in range(256)]
+
+
+def _covered_rows(length):
+    """Extends COVERED_ROWS with the rows of covered labels up to the length"""
+    for n in range(len(COVERED_ROWS), length + 1):
+        COVERED_ROWS.append(bytes([COVERED]) * n)
 
 
 class GreedyExpander(Compressor):
@@ -10,12 +28,16 @@ class GreedyExpander(Compressor):
     neighbours, which shares the domain with the origin block are merged into a
     new block. This continues until no more blocks can be merged. The origin
     block is then moved to the next block in the ParentBlock
+    
+    When the parent block holds only unit sized blocks, which is always the
+    case for freshly parsed data, the blocks are grown on a grid of the
+    domains instead. See _grow_blocks().
     """
-
+    
     def __init__(self, **parameters):
         super(GreedyExpander, self).__init__()
         self.parameters = parameters
-        
+    
     def _suck_in_the_blocks(self, parent_block, block):
         """
         Merges the largest neighbouring set that also matches the domain of the
@@ -46,7 +68,7 @@ class GreedyExpander(Compressor):
                             # block
                             neighbours[i].clear()
                             break
-                            
+        
         # find the direction with the most neighbours
         max_neighbours = ()
         for n in neighbours:
@@ -65,6 +87,44 @@ class GreedyExpander(Compressor):
         Executes the compression algorithm on the specified parent block.
         See the class description for information on how the compressor operates
         
+        Returns the compressed parent block
+        """
+        tags = self._unit_tags(parent_block)
+        if tags is not None:
+            size = parent_block.size
+            parent_block.set_blocks(
+                *self.partition(tags.reshape(size.z, size.y, size.x)))
+            return parent_block
+        
+        return self._compress_by_neighbours(parent_block)
+    
+    def partition(self, tags, upper_bound=None):
+        """
+        Grows the blocks from the cells of a grid of domain tags, indexed as
+        [z, y, x], which gives the same blocks as compressing a parent block
+        of unit blocks. The upper bound isn't used.
+        
+        Returns the blocks as arrays in the same form as
+        ArrayParentBlock.block_arrays(), sorted by the flat index of their
+        origins
+        """
+        size = Size(tags.shape[2], tags.shape[1], tags.shape[0])
+        domains, labels = np.unique(tags, return_inverse=True)
+        if len(domains) >= COVERED:
+            # too many domains to label in a byte
+            parent_block = ArrayParentBlock.from_tags(
+                size, Position(0, 0, 0), tags)
+            return self._compress_by_neighbours(parent_block).block_arrays()
+        
+        boxes = self._grow_blocks(size, labels.astype(np.uint8))
+        table = np.array(boxes, dtype=np.int64).T
+        return table[0:3], table[3:6], domains[table[6]]
+    
+    def _compress_by_neighbours(self, parent_block):
+        """
+        Grows the blocks of the parent block by merging the sets of
+        neighbours of each block, with _suck_in_the_blocks().
+        
         Returns the compressed parent block
         """
         for block in parent_block:
@@ -75,3 +135,137 @@ class GreedyExpander(Compressor):
                 ):
                     break
         return parent_block
+    
+    @staticmethod
+    def _unit_tags(parent_block):
+        """
+        Gets the domains of the cells of the parent block as a flat array in
+        [z, y, x] order, if every block in the parent block is unit sized.
+        Otherwise None is returned.
+        """
+        size = parent_block.size
+        num_cells = size.x * size.y * size.z
+        if isinstance(parent_block, ArrayParentBlock):
+            if parent_block.num_blocks != num_cells:
+                return None
+            return parent_block.tags.ravel()
+        
+        blocks = parent_block.blocks
+        if len(blocks) != num_cells or num_cells <= 1:
+            return None
+        for b in blocks:
+            if not isinstance(b, Block) or b.size != (1, 1, 1):
+                return None
+        return np.array([b.domain for b in blocks])
+    
+    @staticmethod
+    def _grow_blocks(size, labels):
+        """
+        Grows the blocks from the cells in [z, y, x] order, merging exactly
+        the same neighbours as _suck_in_the_blocks() would.
+        
+        Each block can only grow into the cells after its origin, which are
+        still unit sized blocks unless an earlier block has already covered
+        them. So a set of neighbours can be merged only if every cell on that
+        face of the block is uncovered and has the same domain, and then the
+        number of neighbours is the area of the face.
+        
+        The labels of the cells are kept in 2 bytearrays, one with x and the
+        other with y changing fastest, so every row of cells on a face is
+        contiguous in one of them. The rows are checked with
+        bytearray.count(), and covered cells are relabelled with COVERED, so
+        no memory is allocated while the blocks grow.
+        
+        Parameters:
+            size    The size of the parent block
+            labels  The uint8 labels of the domains of the cells, as a flat
+                    array in [z, y, x] order
+        
+        Returns a list of the blocks as tuples of the x, y and z position, the
+        x, y and z size and the label
+        """
+        size_x, size_y, size_z = size
+        plane = size_x * size_y
+        _covered_rows(max(size_x, size_y))
+        grid = labels.reshape(size_z, size_y, size_x)
+        by_x = bytearray(grid.tobytes())
+        by_y = bytearray(grid.transpose(0, 2, 1).tobytes())
+        
+        boxes = []
+        for origin in range(len(by_x)):
+            label = by_x[origin]
+            if label == COVERED:
+                continue
+            z0, rest = divmod(origin, plane)
+            y0, x0 = divmod(rest, size_x)
+            x1 = x0 + 1
+            y1 = y0 + 1
+            z1 = z0 + 1
+            by_x[origin] = COVERED
+            by_y[(z0 * size_x + x0) * size_y + y0] = COVERED
+            target = LABEL_BYTES[label]
+            
+            while True:
+                dx = x1 - x0
+                dy = y1 - y0
+                dz = z1 - z0
+                
+                # the direction with the largest face that can be merged, the
+                # first direction wins a tie
+                best = 0
+                direction = None
+                if x1 < size_x:
+                    for z in range(z0, z1):
+                        start = (z * size_x + x1) * size_y + y0
+                        if by_y.count(target, start, start + dy) != dy:
+                            break
+                    else:
+                        best = dy * dz
+                        direction = Direction.POS_X
+                if y1 < size_y and dx * dz > best:
+                    for z in range(z0, z1):
+                        start = z * plane + y1 * size_x + x0
+                        if by_x.count(target, start, start + dx) != dx:
+                            break
+                    else:
+                        best = dx * dz
+                        direction = Direction.POS_Y
+                if z1 < size_z and dx * dy > best:
+                    for y in range(y0, y1):
+                        start = z1 * plane + y * size_x + x0
+                        if by_x.count(target, start, start + dx) != dx:
+                            break
+                    else:
+                        direction = Direction.POS_Z
+                
+                # cover the cells of the face, and grow the block over them
+                if direction is None:
+                    break
+                elif direction == Direction.POS_X:
+                    for z in range(z0, z1):
+                        start = (z * size_x + x1) * size_y + y0
+                        by_y[start:start + dy] = COVERED_ROWS[dy]
+                        start = z * plane + y0 * size_x + x1
+                        by_x[start:start + dy * size_x:size_x] = \
+                            COVERED_ROWS[dy]
+                    x1 += 1
+                elif direction == Direction.POS_Y:
+                    for z in range(z0, z1):
+                        start = z * plane + y1 * size_x + x0
+                        by_x[start:start + dx] = COVERED_ROWS[dx]
+                        start = (z * size_x + x0) * size_y + y1
+                        by_y[start:start + dx * size_y:size_y] = \
+                            COVERED_ROWS[dx]
+                    y1 += 1
+                else:
+                    for y in range(y0, y1):
+                        start = z1 * plane + y * size_x + x0
+                        by_x[start:start + dx] = COVERED_ROWS[dx]
+                    for x in range(x0, x1):
+                        start = (z1 * size_x + x) * size_y + y0
+                        by_y[start:start + dy] = COVERED_ROWS[dy]
+                    z1 += 1
+            
+            boxes.append((x0, y0, z0, x1 - x0, y1 - y0, z1 - z0, label))
+        
+        return boxes
@@ -0,0 +1,203 @@
+import heapq
+from compressors.compressor import Compressor
+import numpy as np
+
+
+class MaximalCuboid(Compressor):
+    """
+    A Compressor which repeatedly takes the largest box of cells that all
+    share a domain and are not yet part of a block, and makes it a block. This
+    continues until every cell is part of a block.
+    
+    Whether a box holds a single domain is answered in constant time from 3D
+    prefix sum (summed area) tables of the breaks between neighbouring cells,
+    where a break is between cells that differ in domain or where either cell
+    is already part of a block. A box with no breaks inside it is a single
+    domain of free cells. All the boxes with the same y and z size are tested
+    at once, and the x size of the largest one at each position is found from
+    the runs of boxes with the same domain along x.
+    
+    The blocks replace the parent block's blocks only if there are fewer of
+    them, so this compressor never makes a parent block worse.
+    """
+    
+    def __init__(self, **parameters):
+        """
+        Creates a new compressor to compress the block data. Compressors take
+        a set of parameters, which are unique to each compressor. This
+        compressor doesn't take any parameters.
+        """
+        super(MaximalCuboid, self).__init__()
+        self.parameters = parameters
+    
+    def compress(self, parent_block):
+        """
+        Executes the compression algorithm on the specified parent block.
+        See the class description for information on how the compressor
+        operates
+        
+        Returns the compressed parent block
+        """
+        positions, sizes, tags = self.partition(parent_block.tag_grid())
+        if len(tags) < len(parent_block):
+            parent_block.set_blocks(positions, sizes, tags)
+        return parent_block
+    
+    def partition(self, tags, upper_bound=None):
+        """
+        Partitions a grid of domain tags, indexed as [z, y, x], into blocks
+        by repeatedly taking the largest single domain box. The upper bound
+        isn't used.
+        
+        Returns the blocks as arrays in the same form as
+        ArrayParentBlock.block_arrays(), sorted by the flat index of their
+        origins
+        """
+        domains, labels = np.unique(tags, return_inverse=True)
+        labels = labels.reshape(tags.shape)
+        size_z, size_y, size_x = tags.shape
+        
+        # the cells which are not yet part of a block
+        free = np.ones(tags.shape, dtype=bool)
+        
+        # the largest volume each y and z size could still have, which only
+        # shrinks as cells become part of blocks. The largest box is found by
+        # testing the sizes in order of these bounds, until a box is at least
+        # as large as the bound of every size left
+        bounds = [
+            (-size_x * dy * dz, dz, dy)
+            for dz in range(1, size_z + 1)
+            for dy in range(1, size_y + 1)
+        ]
+        heapq.heapify(bounds)
+        
+        # the largest x size each y and z size could still have. A box can't
+        # be longer in x than a box that is smaller in y and z, so finding
+        # the largest box for one size also limits all the larger sizes
+        limits = np.full((size_z + 1, size_y + 1), size_x)
+        
+        # the last largest box found for each size, which is still the
+        # largest box for its size while all its cells are free
+        largest = {}
+        
+        boxes = []
+        changed = True
+        while bounds:
+            bound, dz, dy = heapq.heappop(bounds)
+            limit = int(limits[dz, dy]) * dy * dz
+            if limit < -bound:
+                if limit:
+                    heapq.heappush(bounds, (-limit, dz, dy))
+                continue
+            
+            box = largest.get((dz, dy))
+            if box is None or not self._is_free(free, box):
+                if changed:
+                    breaks = self._breaks(labels, free)
+                    changed = False
+                box = self._largest_box(labels, free, breaks, dy, dz)
+                if box is None:
+                    # no box of this size, or larger, will fit ever again
+                    limits[dz:, dy:] = 0
+                    continue
+                largest[dz, dy] = box
+                np.minimum(limits[dz:, dy:], box[3], out=limits[dz:, dy:])
+            
+            volume = box[3] * dy * dz
+            if bounds and volume < -bounds[0][0]:
+                heapq.heappush(bounds, (-volume, dz, dy))
+                continue
+            
+            if volume == 1:
+                # the cells left can only be unit blocks
+                for z, y, x in zip(*np.nonzero(free)):
+                    boxes.append((x, y, z, 1, 1, 1, labels[z, y, x]))
+                break
+            
+            x, y, z, dx, _, _, label = box
+            boxes.append(box)
+            free[z:z + dz, y:y + dy, x:x + dx] = False
+            changed = True
+            heapq.heappush(bounds, (-volume, dz, dy))
+        
+        # order the blocks by their origins, like the blocks of a parent block
+        boxes.sort(key=lambda b: (b[2], b[1], b[0]))
+        table = np.array(boxes, dtype=np.int64).reshape(-1, 7).T
+        return table[0:3], table[3:6], domains[table[6]]
+    
+    @staticmethod
+    def _is_free(free, box):
+        """Checks if all the cells of the box are still free"""
+        x, y, z, dx, dy, dz, _ = box
+        return free[z:z + dz, y:y + dy, x:x + dx].all()
+    
+    @staticmethod
+    def _breaks(labels, free):
+        """
+        Builds the prefix sum tables of the breaks between each cell and the
+        next cell along y, and along z. The tables are summed over z and y,
+        so the breaks in any rectangle of cells in the same x can be counted.
+        
+        Returns a tuple of the tables for the breaks along y and along z
+        """
+        size_z, size_y, size_x = labels.shape
+        
+        joined = free[:, :-1] & free[:, 1:] & (labels[:, :-1] == labels[:, 1:])
+        along_y = np.zeros((size_z + 1, size_y, size_x), dtype=np.int32)
+        np.cumsum(~joined, axis=0, out=along_y[1:, 1:])
+        np.cumsum(along_y, axis=1, out=along_y)
+        
+        joined = free[:-1] & free[1:] & (labels[:-1] == labels[1:])
+        along_z = np.zeros((size_z, size_y + 1, size_x), dtype=np.int32)
+        np.cumsum(~joined, axis=0, out=along_z[1:, 1:])
+        np.cumsum(along_z, axis=1, out=along_z)
+        
+        return along_y, along_z
+    
+    @staticmethod
+    def _largest_box(labels, free, breaks, dy, dz):
+        """
+        Finds the largest box of free cells of a single domain with the y and
+        z size, using the prefix sums of the breaks between cells. The first
+        box in [z, y, x] order is taken if there is a tie.
+        
+        Returns the box as a tuple of the x, y and z position, the x, y and z
+        size and the domain label, or None if there is no such box
+        """
+        along_y, along_z = breaks
+        
+        # the number of breaks inside the boxes of 1 x dy x dz cells at every
+        # position. The breaks along y are between rows 0 to dy - 1 of a box,
+        # and the breaks along z are between its layers 0 to dz - 1
+        p = along_y
+        h = dy - 1
+        count = p[dz:, h:] - p[:-dz, h:] - p[dz:, :p.shape[1] - h] \
+            + p[:-dz, :p.shape[1] - h]
+        p = along_z
+        h = dz - 1
+        count = count + (
+            p[h:, dy:] - p[:p.shape[0] - h, dy:] - p[h:, :-dy]
+            + p[:p.shape[0] - h, :-dy]
+        )
+        
+        # a box is a single domain of free cells if it has no breaks, and the
+        # cell at its origin is free
+        single = (count == 0) & free[:count.shape[0], :count.shape[1]]
+        if not single.any():
+            return None
+        domain = labels[:count.shape[0], :count.shape[1]]
+        
+        # the x size of the largest box at each position is the number of
+        # boxes in a row along x with the same domain. Each run of boxes ends
+        # at the first position where the next box along x differs
+        size_x = domain.shape[2]
+        xs = np.arange(size_x)
+        joined = np.zeros(domain.shape, dtype=bool)
+        joined[:, :, :-1] = single[:, :, 1:] & \
+            (domain[:, :, :-1] == domain[:, :, 1:])
+        ends = np.where(joined, size_x, xs)
+        ends = np.minimum.accumulate(ends[:, :, ::-1], axis=2)[:, :, ::-1]
+        runs = np.where(single, ends - xs + 1, 0)
+        
+        z, y, x = np.unravel_index(runs.argmax(), runs.shape)
+        return (x, y, z, int(runs[z, y, x]), dy, dz, int(domain[z, y, x]))
@@ -0,0 +1,133 @@
+from compressors.compressor import Compressor
+import numpy as np
+
+
+class Octree(Compressor):
+    """
+    A Compressor which splits the parent block in half along each dimension,
+    into 8 octants, and each octant in half again, down to single cells. Every
+    octant whose cells all share a domain becomes a block, unless the octant
+    it is part of already is one.
+    
+    Sizes which are not a power of 2 are split unevenly, with the larger half
+    first, e.g. 14 cells are split into 7 and 7, then 4 and 3, and so on. A
+    dimension stops being split once it is a single cell, so the octants of
+    a parent block that is flat in one dimension are split into 4, like a
+    k-d tree.
+    
+    Whether each octant holds a single domain is worked out from the bottom
+    up, as a reduction of the minimum and maximum domain of the octants on
+    one level to those of the level above. So the compressor takes time in
+    proportion to the number of cells, whatever the domains are.
+    
+    The blocks replace the parent block's blocks only if there are fewer of
+    them, so this compressor never makes a parent block worse.
+    """
+    
+    def __init__(self, **parameters):
+        """
+        Creates a new compressor to compress the block data. Compressors take
+        a set of parameters, which are unique to each compressor. This
+        compressor doesn't take any parameters.
+        """
+        super(Octree, self).__init__()
+        self.parameters = parameters
+    
+    def compress(self, parent_block):
+        """
+        Executes the compression algorithm on the specified parent block.
+        See the class description for information on how the compressor
+        operates
+        
+        Returns the compressed parent block
+        """
+        positions, sizes, tags = self.partition(parent_block.tag_grid())
+        if len(tags) < len(parent_block):
+            parent_block.set_blocks(positions, sizes, tags)
+        return parent_block
+    
+    @staticmethod
+    def _levels(size):
+        """
+        Splits a dimension of the given size in half, level by level, until
+        every part is a single cell.
+        
+        Returns a list of the levels from the top, where each level is an
+        array of the start of every part, followed by the end of the last
+        part
+        """
+        levels = [np.array([0, size])]
+        while len(levels[-1]) <= size:
+            bounds = levels[-1]
+            halves = (bounds[:-1] + bounds[1:] + 1) // 2
+            levels.append(np.unique(np.concatenate((bounds, halves))))
+        return levels
+    
+    def partition(self, tags, upper_bound=None):
+        """
+        Partitions a grid of domain tags, indexed as [z, y, x], into the
+        largest octants that each hold a single domain. The upper bound isn't
+        used.
+        
+        Returns the blocks as arrays in the same form as
+        ArrayParentBlock.block_arrays(), sorted by the flat index of their
+        origins
+        """
+        # the parts of each dimension on every level, with the dimensions
+        # that are split into single cells first repeated at the bottom
+        axes = [self._levels(n) for n in tags.shape]
+        depth = max(len(levels) for levels in axes)
+        for levels in axes:
+            levels.extend([levels[-1]] * (depth - len(levels)))
+        
+        # the smallest and largest domain in each octant, from the cells up
+        lowest = [tags]
+        highest = [tags]
+        for level in range(depth - 2, -1, -1):
+            low = lowest[0]
+            high = highest[0]
+            for axis, levels in enumerate(axes):
+                # where each part of this level starts among the parts of the
+                # level below
+                starts = np.searchsorted(levels[level + 1], levels[level][:-1])
+                low = np.minimum.reduceat(low, starts, axis=axis)
+                high = np.maximum.reduceat(high, starts, axis=axis)
+            lowest.insert(0, low)
+            highest.insert(0, high)
+        
+        # take the single domain octants from the top down, skipping those
+        # inside an octant already taken
+        positions = []
+        sizes = []
+        block_tags = []
+        taken = np.zeros((1, 1, 1), dtype=bool)
+        for level in range(depth):
+            if level > 0:
+                # spread whether each octant was taken to the octants in it
+                for axis, levels in enumerate(axes):
+                    starts = np.searchsorted(
+                        levels[level - 1], levels[level][:-1], side='right')
+                    taken = np.take(taken, starts - 1, axis=axis)
+            
+            single = lowest[level] == highest[level]
+            new = single & ~taken
+            z, y, x = np.nonzero(new)
+            bounds_z, bounds_y, bounds_x = (
+                levels[level] for levels in axes)
+            positions.append(
+                np.stack((bounds_x[x], bounds_y[y], bounds_z[z])))
+            sizes.append(np.stack((
+                bounds_x[x + 1] - bounds_x[x],
+                bounds_y[y + 1] - bounds_y[y],
+                bounds_z[z + 1] - bounds_z[z])))
+            block_tags.append(lowest[level][z, y, x])
+            taken = taken | single
+        
+        positions = np.concatenate(positions, axis=1)
+        sizes = np.concatenate(sizes, axis=1)
+        block_tags = np.concatenate(block_tags)
+        
+        # order the blocks by their origins, like the blocks of a parent block
+        x, y, z = positions
+        order = np.argsort(np.ravel_multi_index((z, y, x), tags.shape))
+        return positions[:, order], sizes[:, order], block_tags[order]
@@ -0,0 +1,263 @@
+import time
+from compressors.compressor import Compressor
+from compressors.GreedyExpander import GreedyExpander
+import numpy as np
+
+# the largest parent block, in cells, that is searched by default
+MAX_CELLS = 64
+
+# the default number of boxes that can be solved for a parent block
+MAX_NODES = 20000
+
+# how often the time limit is checked, in boxes solved
+TIME_CHECK_INTERVAL = 256
+
+
+class OptimalPartitioner(Compressor):
+    """
+    A Compressor which searches for the fewest blocks a small parent block can
+    be split into. Every box of cells is either a single block, if all its
+    cells share a domain, or is cut in 2 along x, y or z and each half is
+    partitioned in turn. The fewest blocks over all the cuts is found with
+    dynamic programming, where the result for each box is memoized, and cuts
+    which can't beat the best so far are pruned. The lower bound for a box is
+    the number of domains in it.
+    
+    This finds the best partition that can be made by cutting boxes in 2,
+    which is usually, but not always, the best partition overall. The search
+    has a budget, and if the budget runs out the search stops and keeps the
+    best partition found so far, where the boxes that weren't solved yet are
+    partitioned by the GreedyExpander. The parent block is compressed by the
+    GreedyExpander first, and its blocks are only replaced if the search
+    finds fewer, so parent blocks which are too large to search are left
+    with the greedy blocks.
+    
+    Parameters:
+        max_cells   Parent blocks with more cells than this are not searched
+        max_nodes   The number of boxes that can be solved for a parent block
+        time_limit  The number of seconds that can be spent on a parent
+                    block, or None for no time limit
+    
+    Attributes:
+        exhausted   Whether the last search ran out of its budget
+    """
+    
+    def __init__(self, **parameters):
+        super(OptimalPartitioner, self).__init__()
+        self.parameters = parameters
+        self.max_cells = parameters.get('max_cells', MAX_CELLS)
+        self.max_nodes = parameters.get('max_nodes', MAX_NODES)
+        self.time_limit = parameters.get('time_limit', None)
+        self.greedy = GreedyExpander()
+        self.exhausted = False
+    
+    def compress(self, parent_block):
+        """
+        Executes the compression algorithm on the specified parent block.
+        See the class description for information on how the compressor
+        operates
+        
+        Returns the compressed parent block
+        """
+        size = parent_block.size
+        tags = parent_block.tag_grid()
+        parent_block = self.greedy.compress(parent_block)
+        if not self.searchable((size.z, size.y, size.x)):
+            return parent_block
+        
+        # cutting boxes in 2 can't make every partition, so the greedy blocks
+        # are only replaced if the search finds fewer
+        blocks = self.partition(tags, len(parent_block))
+        if blocks is not None:
+            parent_block.set_blocks(*blocks)
+        return parent_block
+    
+    def searchable(self, shape):
+        """
+        Gets whether a grid of the shape is searched, which it is if it has
+        no more than max_cells cells and no more boxes than max_nodes. With
+        more boxes, the search would run out of budget before it could solve
+        them all.
+        """
+        num_cells = 1
+        num_boxes = 1
+        for n in shape:
+            num_cells *= n
+            num_boxes *= n * (n + 1) // 2
+        return num_cells <= self.max_cells and num_boxes <= self.max_nodes
+    
+    def estimate(self, tags):
+        """
+        Parent blocks which aren't searchable() aren't searched, so there is
+        no partition to be found for them.
+        """
+        if not self.searchable(tags.shape):
+            return float('inf')
+        return 1
+    
+    def partition(self, tags, upper_bound=None):
+        """
+        Partitions a grid of domain tags, indexed as [z, y, x], into the
+        fewest blocks that can be made by cutting boxes in 2.
+        
+        Parameters:
+            tags        The grid of domain tags
+            upper_bound The number of blocks of a known partition. Only
+                        partitions with fewer blocks are searched for
+        
+        Returns the blocks as arrays in the same form as
+        ArrayParentBlock.block_arrays(), sorted by the flat index of their
+        origins, or None if there is no partition with fewer blocks than the
+        upper bound. If the budget runs out, exhausted is set and the best
+        partition found so far is returned.
+        """
+        domains, label_grid = np.unique(tags, return_inverse=True)
+        label_grid = label_grid.reshape(tags.shape)
+        labels = label_grid.tolist()
+        size_z, size_y, size_x = tags.shape
+        
+        if self.time_limit is None:
+            deadline = None
+        else:
+            deadline = time.perf_counter() + self.time_limit
+        max_nodes = self.max_nodes
+        
+        # the set of domains in each box, as a bit mask of the labels
+        masks = {}
+        
+        def mask(box):
+            try:
+                return masks[box]
+            except KeyError:
+                pass
+            x0, x1, y0, y1, z0, z1 = box
+            if x1 - x0 > 1:
+                half = (x0 + x1) // 2
+                m = mask((x0, half, y0, y1, z0, z1)) | \
+                    mask((half, x1, y0, y1, z0, z1))
+            elif y1 - y0 > 1:
+                half = (y0 + y1) // 2
+                m = mask((x0, x1, y0, half, z0, z1)) | \
+                    mask((x0, x1, half, y1, z0, z1))
+            elif z1 - z0 > 1:
+                half = (z0 + z1) // 2
+                m = mask((x0, x1, y0, y1, z0, half)) | \
+                    mask((x0, x1, y0, y1, half, z1))
+            else:
+                m = 1 << labels[z0][y0][x0]
+            masks[box] = m
+            return m
+        
+        def lower_bound(box):
+            return bin(mask(box)).count('1')
+        
+        # the fewest blocks for each box, and the cut that gives them, which
+        # is None if the box is a single block
+        solved = {}
+        
+        # the blocks of the boxes partitioned by the GreedyExpander, once the
+        # budget has run out
+        leaves = {}
+        self.exhausted = False
+        
+        def leaf(box):
+            x0, x1, y0, y1, z0, z1 = box
+            blocks = self.greedy.partition(label_grid[z0:z1, y0:y1, x0:x1])
+            leaves[box] = blocks
+            solved[box] = (len(blocks[2]), None)
+            return len(blocks[2])
+        
+        def solve(box, bound=None):
+            try:
+                return solved[box][0]
+            except KeyError:
+                pass
+            if not self.exhausted and (len(solved) >= max_nodes or (
+                    deadline is not None and
+                    len(solved) % TIME_CHECK_INTERVAL == 0 and
+                    time.perf_counter() > deadline)):
+                self.exhausted = True
+            
+            least = lower_bound(box)
+            if least == 1:
+                solved[box] = (1, None)
+                return 1
+            if self.exhausted:
+                return leaf(box)
+            
+            # the bound is only given for the whole parent block, so every
+            # other box is solved exactly and can be memoized, until the
+            # budget runs out
+            best = bound
+            best_cut = None
+            for first, second in self._cuts(box):
+                if self.exhausted:
+                    break
+                if best is not None and \
+                        lower_bound(first) + lower_bound(second) >= best:
+                    continue
+                count = solve(first)
+                if best is not None and count + lower_bound(second) >= best:
+                    continue
+                count += solve(second)
+                if best is None or count < best:
+                    best = count
+                    best_cut = (first, second)
+                    if best == least:
+                        # can't do better than 1 block for each domain
+                        break
+            
+            if best_cut is None and self.exhausted:
+                # the budget ran out before any cut of the box was solved
+                return leaf(box)
+            solved[box] = (best, best_cut)
+            return best
+        
+        root = (0, size_x, 0, size_y, 0, size_z)
+        count = solve(root, upper_bound)
+        if upper_bound is not None and count >= upper_bound:
+            return None
+        
+        # follow the cuts to collect the blocks
+        boxes = []
+        pending = [root]
+        while pending:
+            box = pending.pop()
+            cut = solved[box][1]
+            if box in leaves:
+                x0, _, y0, _, z0, _ = box
+                positions, sizes, block_labels = leaves[box]
+                for (x, y, z), size, label in zip(
+                        positions.T.tolist(), sizes.T.tolist(),
+                        block_labels.tolist()):
+                    boxes.append((x0 + x, y0 + y, z0 + z, *size, label))
+            elif cut is None:
+                x0, x1, y0, y1, z0, z1 = box
+                boxes.append((
+                    x0, y0, z0, x1 - x0, y1 - y0, z1 - z0, labels[z0][y0][x0]))
+            else:
+                pending.extend(cut)
+        
+        # order the blocks by their origins, like the blocks of a parent block
+        boxes.sort(key=lambda b: (b[2], b[1], b[0]))
+        table = np.array(boxes, dtype=np.int64).reshape(-1, 7).T
+        return table[0:3], table[3:6], domains[table[6]]
+    
+    @staticmethod
+    def _cuts(box):
+        """
+        Generates every way to cut the box in 2, as pairs of boxes. The cuts
+        nearest the middle of the box are generated first along each axis, as
+        they tend to split the box into more even halves.
+        """
+        x0, x1, y0, y1, z0, z1 = box
+        for lo, hi, axis in ((x0, x1, 0), (y0, y1, 1), (z0, z1, 2)):
+            middle = (lo + hi) // 2
+            order = sorted(range(lo + 1, hi), key=lambda c: abs(c - middle))
+            for c in order:
+                if axis == 0:
+                    yield (x0, c, y0, y1, z0, z1), (c, x1, y0, y1, z0, z1)
+                elif axis == 1:
+                    yield (x0, x1, y0, c, z0, z1), (x0, x1, c, y1, z0, z1)
+                else:
+                    yield (x0, x1, y0, y1, z0, c), (x0, x1, y0, y1, c, z1)
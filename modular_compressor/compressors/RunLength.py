@@ -1,8 +1,8 @@
 from compressors.compressor import Compressor
-from model import Block, Position, Dimension
+import numpy as np
 
-
-# WARNING: THIS COMPRESSOR IS INCOMPLETE, DO NOT USE YET
+# the axis of the [z, y, x] grid of domains for each dimension
+AXES = {'x': 2, 'y': 1, 'z': 0}
 
 
 class RunLength(Compressor):
@@ -10,61 +10,81 @@ class RunLength(Compressor):
     A Compressor which works along a single dimension and to combine all the
     blocks of the same domain into 1 block. It will only work in a single
     dimension.
+    
+    The runs are found by comparing each slice of the grid of domains with the
+    slice before it along the dimension, so a run starts at every cell whose
+    domain differs from the cell before it.
+    
+    The blocks replace the parent block's blocks only if there are fewer of
+    them, so this compressor never makes a parent block worse.
     """
-
+    
     def __init__(self, **parameters):
         """
         Creates a new compressor to compress the block data. Compressors take
         a set of parameters, which are unique to each compressor. This
-        compressor takes the parameter "dimension", which has one of the values:
-        "x", "y", "z"
+        compressor takes the parameter "dimension", which has one of the
+        values: "x", "y", "z"
         """
-        super(SameDomain, self).__init__()
+        super(RunLength, self).__init__()
         self.parameters = parameters
-        if 'dimension' not in self.parementers:
+        if 'dimension' not in self.parameters:
             self.parameters['dimension'] = 'x'
-
-    def _run_length_compress(self, parent_block, block):
-        if self.parameters['dimension'] is 'y':
-            neighbours = parent_block.get_neighbours(block, Direction.POS_Y)
-            skip_i = 1
-        elif self.parameters['dimension'] is 'z':
-            neighbours = parent_block.get_neighbours(block, Direction.POS_Z)
-            skip_i = 2
-        else:
-            neighbours = parent_block.get_neighbours(block, Direction.POS_X)
-            skip_i = 3
-        
-        # check if we can merge all the neighbours
-        for n in neighbours:
-            if n.domain != block.domain:
-                # all the domains don't match
-                neighbours.clear()
-                break
-            else:
-                for i in range(3):
-                    if i == skip_i:
-                        continue
-                    if n.position[i] < block.position[i]
-                        or (n.position[i] + n.size[i]) > (block.position[i] + block.size[i]):  # noqa
-                            # a neighbour starts of ends past the edge of this
-                            # block
-                            neighbours.clear()
-                            
-        if len(neighbours) > 0:
-            parent_block.combine_blocks(block, *neighbours)
-            return True
-        else:
-            return False
-                        
+        if self.parameters['dimension'] not in AXES:
+            raise ValueError(
+                "dimension must be one of 'x', 'y' or 'z', not {!r}".format(
+                    self.parameters['dimension']))
+    
     def compress(self, parent_block):
         """
         Executes the compression algorithm on the specified parent block.
         
         Returns the compressed parent block
         """
-        for block in parent_block:
-            while True:
-                if not self._run_length_compress(block):
-                    break
+        positions, sizes, tags = self.partition(parent_block.tag_grid())
+        if len(tags) < len(parent_block):
+            parent_block.set_blocks(positions, sizes, tags)
         return parent_block
+    
+    def estimate(self, tags):
+        """
+        Counts the runs along the dimension, which is exactly the number of
+        blocks partition() gives, without building the blocks.
+        """
+        axis = AXES[self.parameters['dimension']]
+        lines = tags.size // tags.shape[axis]
+        return lines + np.count_nonzero(np.diff(tags, axis=axis))
+    
+    def partition(self, tags, upper_bound=None):
+        """
+        Partitions a grid of domain tags, indexed as [z, y, x], into the runs
+        of cells with the same domain along the dimension. The upper bound
+        isn't used.
+        
+        Returns the blocks as arrays in the same form as
+        ArrayParentBlock.block_arrays(), sorted by the flat index of their
+        origins
+        """
+        axis = AXES[self.parameters['dimension']]
+        
+        # move the dimension to the last axis, so each run is contiguous
+        lines = np.moveaxis(tags, axis, -1)
+        starts = np.ones(lines.shape, dtype=bool)
+        starts[..., 1:] = lines[..., 1:] != lines[..., :-1]
+        
+        # every line starts with a run, so each run ends where the next run
+        # starts, whether it is on the same line or the next one
+        first = np.flatnonzero(starts)
+        lengths = np.diff(first, append=lines.size)
+        
+        coordinates = list(np.unravel_index(first, lines.shape))
+        coordinates.insert(axis, coordinates.pop())
+        z, y, x = coordinates
+        
+        sizes = np.ones((3, len(first)), dtype=np.int64)
+        sizes[2 - axis] = lengths
+        
+        # order the blocks by their origins, like the blocks of a parent block
+        order = np.argsort(np.ravel_multi_index((z, y, x), tags.shape))
+        positions = np.stack((x, y, z))[:, order]
+        return positions, sizes[:, order], tags[z, y, x][order]
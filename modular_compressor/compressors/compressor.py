@@ -1,9 +1,45 @@
+import numpy as np
+
+
+def lower_bound(tags):
+    """
+    Gets the fewest blocks that any partition of a grid of domain tags,
+    indexed as [z, y, x], into blocks of a single domain can have.
+    
+    Every domain needs a block. Also, when the neighbours of a cell towards
+    one of its corners, along x, y and z, all have other domains (or are
+    outside the grid), the block covering the cell must have a corner there.
+    A block has 8 corners, so there must be at least an eighth as many blocks
+    as these corners.
+    """
+    # whether the neighbour before and after each cell along each axis has
+    # another domain, or is outside the grid
+    ends = []
+    for axis in range(3):
+        differ = np.diff(tags, axis=axis) != 0
+        shape = list(tags.shape)
+        shape[axis] = 1
+        edge = np.ones(shape, dtype=bool)
+        ends.append((
+            np.concatenate((edge, differ), axis=axis),
+            np.concatenate((differ, edge), axis=axis)
+        ))
+    
+    corners = 0
+    for along_z in ends[0]:
+        for along_y in ends[1]:
+            corners += np.count_nonzero(along_z & along_y & ends[2][0])
+            corners += np.count_nonzero(along_z & along_y & ends[2][1])
+    
+    return max(len(np.unique(tags)), -(-corners // 8))
+
+
 class Compressor:
     """
     A Basic Compressor that does nothing, but provides a base class for other
     compressors
     """
-
+    
     def __init__(self, **parameters):
         """
         Creates a new compressor to compress the block data. Compressors take
@@ -12,7 +48,7 @@ class Compressor:
         """
         super(Compressor, self).__init__()
         self.parameters = parameters
-
+    
     def compress(self, parent_block):
         """
         Executes the compression algorithm on the specified parent block.
@@ -23,3 +59,35 @@ class Compressor:
         This base class does not provide any compression.
         """
         pass
+    
+    def partition(self, tags, upper_bound=None):
+        """
+        Partitions a grid of domain tags, indexed as [z, y, x], into blocks
+        of a single domain, without changing any parent block. Compressors
+        which implement this can be used as strategies by the compression
+        engine, which keeps the partition with the fewest blocks.
+        
+        Parameters:
+            tags        The grid of domain tags
+            upper_bound The number of blocks of the best partition found so
+                        far, which compressors may use to give up early
+        
+        Returns the blocks as arrays in the same form as
+        ArrayParentBlock.block_arrays(), sorted by the flat index of their
+        origins, or None if no partition with fewer blocks than the upper
+        bound was found
+        
+        This base class does not provide a partition, so always gives None
+        """
+        return None
+    
+    def estimate(self, tags):
+        """
+        Estimates the fewest blocks that partition() could give for the grid
+        of domain tags, which must never be more than it gives. The
+        compression engine skips the compressor when the estimate shows it
+        can't beat the best partition found so far.
+        
+        This base class gives no estimate, so the compressor is never skipped
+        """
+        return 1
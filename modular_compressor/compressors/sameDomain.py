@@ -1,5 +1,5 @@
 from compressors.compressor import Compressor
-from model import Block, Position
+from model import Block, Position, ArrayParentBlock
 
 
 class SameDomain(Compressor):
@@ -28,10 +28,15 @@ class SameDomain(Compressor):
         Returns the compressed parent block
         """
         domain = parent_block.get_block(0, 0, 0).domain
-        for block in parent_block:
-            if block.domain != domain:
-                # not all the domains are the same, get out of here quick!
+        if isinstance(parent_block, ArrayParentBlock):
+            # compare the whole grid of domains at once
+            if (parent_block.tags != domain).any():
                 return parent_block
+        else:
+            for block in parent_block:
+                if block.domain != domain:
+                    # not all the domains are the same, get out of here quick!
+                    return parent_block
         
         # if we get here, there is only one domain
         new_block = Block(
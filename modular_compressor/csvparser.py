@@ -4,9 +4,34 @@ internal representation. It should only read 1 ParentBlock slice in the z
 direction. This requires that the CSV data is in sorted in the z direction.
 """
 
-from model import Size, Position, Block, ParentBlock
+from model import Size, Position, Block, ParentBlock, ArrayParentBlock
+from sharedslab import SharedSlab, release_slabs
+import instrumentation
+import tracing
 import csv
 import sys
+import numpy as np
+
+# the number of bytes to read from the input at a time in bulk mode
+READ_CHUNK_SIZE = 1 << 22
+
+# the most digits a number can have in bulk mode, as any more can overflow an
+# int64. Longer numbers are left to the csv reader
+MAX_DIGITS = 18
+
+POWERS_OF_10 = 10 ** np.arange(MAX_DIGITS, dtype=np.int64)
+
+
+def _gather(buf, starts, ends, fill):
+    """
+    Gathers the bytes of buf between each start and end into the rows of a 2D
+    array. The rows are padded at the end with the fill value.
+    """
+    lengths = ends - starts
+    width = max(int(lengths.max()), 1)
+    offsets = np.arange(width, dtype=starts.dtype)
+    index = np.minimum(starts[:, None] + offsets, len(buf) - 1)
+    return np.where(offsets < lengths[:, None], buf[index], np.uint8(fill))
 
 
 class CSVParser:
@@ -18,27 +43,53 @@ class CSVParser:
         model       The model to place the parsed ParentBlocks
         in_file     The file to read the data from. It defaults to STDIN
         out_file    The file to write to to. It defaults to STDOUT
+        parent_block_type
+                    The class used to store the parent blocks, either
+                    ParentBlock or ArrayParentBlock. It defaults to ParentBlock
+        bulk        If True, a whole slice is read at once and parsed with
+                    NumPy, instead of parsing 1 row at a time. The parent
+                    blocks are always ArrayParentBlocks in bulk mode.
+        shared      If True, in bulk mode, the tags of each slice are placed
+                    in a SharedSlab for the worker processes to read. The
+                    parent blocks of the slice hold the slab as their `slab`
     """
 
-    def __init__(self, model, in_file=sys.stdin, out_file=sys.stdout):
+    def __init__(self, model, in_file=sys.stdin, out_file=sys.stdout,
+                 parent_block_type=ParentBlock, bulk=False, shared=False):
         super(CSVParser, self).__init__()
         
         self.model = model
+        self.parent_block_type = parent_block_type
+        self.bulk = bulk
+        self.shared = shared
         
         # open the in file
         if in_file == sys.stdin:
             self.in_file = sys.stdin
         else:
-            self.in_file = open(out_file, newline='')
+            self.in_file = open(in_file, newline='')
             
-        # open the out file
+        # open the out file, the blocks are written straight to its bytes
         if out_file == sys.stdout:
             self.out_file = sys.stdout
         else:
-            self.out_file = open(out_file, newline='')
+            self.out_file = open(out_file, 'w', newline='')
+        self.out_bytes = self.out_file.buffer
+        
+        # the encoded end of each row, for each (size, domain) pair written
+        self.row_endings = {}
             
         # create the csv reader/writer
-        self.reader = csv.reader(self.in_file)
+        if self.bulk:
+            # bulk mode reads the underlying bytes, so all the rows need to
+            # come from there, including any read by the csv reader
+            self.parent_block_type = ArrayParentBlock
+            self.in_bytes = self.in_file.buffer
+            self.pending = b''
+            self.offset = 0
+            self.reader = csv.reader(self._lines())
+        else:
+            self.reader = csv.reader(self.in_file)
         self.writer = csv.writer(self.out_file)
         
         # read the parent block line
@@ -47,6 +98,7 @@ class CSVParser:
             sys.exit(1)     # perhaps throw an error instead
             
         self.writer.writerow((header[0], header[1], header[2], header[3], header[4], header[5]))  # noqa
+        self.out_file.flush()
         
         header[0] = header[0].split()[1]    # remove the starting '#'
         self.model.size = Size(x=int(header[0]), y=int(header[1]), z=int(header[2]))    # noqa
@@ -68,12 +120,39 @@ class CSVParser:
         Returns:
             The number of blocks parsed
         """
+        num_rows, pbs = self.read_slice()
+        
+        # add all the parent blocks to the model
+        for pb in pbs:
+            self.model.append(pb)
+        
+        # return the number of rows read
+        return num_rows
+    
+    @instrumentation.timed('parse')
+    @tracing.traced('read', lambda self: {'slab': self.slices})
+    def read_slice(self):
+        """
+        Reads the next parent block slice of data, the same as read(), but
+        returns the parent blocks instead of adding them to the model.
+        
+        Returns:
+            A tuple of the number of blocks parsed and the list of the parent
+            blocks in the slice
+        """
         # calculate the number of parent blocks in the slice in each dimension
         num_pbs_x = self.model.size.x // self.model.parent_block_size.x
         num_pbs_y = self.model.size.y // self.model.parent_block_size.y
         
+        if self.bulk:
+            num_rows, pbs = self._read_bulk(num_pbs_x, num_pbs_y)
+            if pbs is not None:
+                self.slices += 1
+                instrumentation.count('blocks_in', num_rows)
+                return num_rows, pbs
+        
         # create an array of all the parent blocks
-        pbs = [ParentBlock(
+        pbs = [self.parent_block_type(
                 size=self.model.parent_block_size,
                 position=Position(x * self.model.parent_block_size.x, y * self.model.parent_block_size.y, self.slices * self.model.parent_block_size.z)    # noqa
                ) for y in range(num_pbs_y) for x in range(num_pbs_x)
@@ -88,6 +167,11 @@ class CSVParser:
                      
         num_rows = 0
         
+        if self.bulk:
+            # the rows couldn't be parsed in bulk, so parse them 1 at a time
+            self.pending = self.slab + self.pending[self.offset:]
+            self.offset = 0
+        
         while num_rows < num_blocks:
             # try to read the next row
             try:
@@ -131,12 +215,234 @@ class CSVParser:
             
             num_rows += 1
         
-        # add all the parent blocks to the model
-        for pb in pbs:
-            self.model.append(pb)
+        instrumentation.count('blocks_in', num_rows)
+        return num_rows, pbs
+    
+    def _lines(self):
+        """
+        A generator of the lines of the input in bulk mode. The lines are
+        decoded from the bytes that haven't yet been read by _read_bulk().
+        """
+        while True:
+            end = self.pending.find(b'\n', self.offset) + 1
+            if end == 0:
+                chunk = self.in_bytes.read(READ_CHUNK_SIZE)
+                self.pending = self.pending[self.offset:] + chunk
+                self.offset = 0
+                if chunk:
+                    continue
+                if not self.pending:
+                    return
+                end = len(self.pending)     # the last line has no line ending
+            line = self.pending[self.offset:end]
+            self.offset = end
+            yield line.decode()
+            
+    def _read_slab_bytes(self, num_rows):
+        """
+        Reads the bytes of the next num_rows rows of data from the input.
+        Comment and blank lines are dropped, so they aren't counted as rows.
+        """
+        self.pending = self.pending[self.offset:]
+        self.offset = 0
         
-        # return the number of rows read
-        return num_rows
+        slab = b''
+        end_of_file = False
+        while num_rows > 0 and not end_of_file:
+            chunks = [self.pending]
+            count = self.pending.count(b'\n')
+            while count < num_rows:
+                chunk = self.in_bytes.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    end_of_file = True
+                    break
+                chunks.append(chunk)
+                count += chunk.count(b'\n')
+            data = b''.join(chunks)
+            
+            if count >= num_rows:
+                newlines = np.flatnonzero(
+                    np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+                end = newlines[num_rows - 1] + 1
+                data, self.pending = data[:end], data[end:]
+            else:
+                self.pending = b''
+                if data and not data.endswith(b'\n'):
+                    data += b'\n'      # the last line has no line ending
+            
+            if data.startswith((b'#', b'\n', b'\r')) or b'\n#' in data \
+                    or b'\n\n' in data or b'\n\r\n' in data:
+                lines = [line for line in data.splitlines(keepends=True)
+                         if line[0] != ord('#') and line.strip()]
+                data = b''.join(lines)
+            
+            slab += data
+            num_rows -= data.count(b'\n')
+        return slab
+            
+    def _read_bulk(self, num_pbs_x, num_pbs_y):
+        """
+        Reads a parent block slice of rows at once and parses them with
+        vectorised NumPy operations. The domain tags are placed in a grid of
+        the whole slice, which is then split into the parent blocks.
+        
+        Returns:
+            A tuple of the number of rows parsed and the list of parent
+            blocks. If the rows can't be parsed in bulk, because they are not
+            all the expected unit blocks, the list of parent blocks is None
+            and the rows need to be parsed by read() instead.
+        """
+        pb_size = self.model.parent_block_size
+        z_start = self.slices * pb_size.z
+        shape = (pb_size.z, self.model.size.y, self.model.size.x)
+        num_blocks = shape[0] * shape[1] * shape[2]
+        
+        self.slab = self._read_slab_bytes(num_blocks)
+        if not self.slab:
+            return 0, []
+        
+        parsed = self._parse_slab(self.slab)
+        if parsed is None:
+            return 0, None
+        coordinates, sizes, domains = parsed
+        
+        x = coordinates[:, 0]
+        y = coordinates[:, 1]
+        z = coordinates[:, 2] - z_start
+        if len(x) != num_blocks or (sizes != 1).any() \
+                or x.min() < 0 or x.max() >= shape[2] \
+                or y.min() < 0 or y.max() >= shape[1] \
+                or z.min() < 0 or z.max() >= shape[0]:
+            return 0, None
+        
+        # a slice of a single domain doesn't need compressing, so it doesn't
+        # need to be shared with the workers
+        uniform = (domains == domains[0]).all()
+        
+        # scatter the tags into the grid, all the cells must be filled. The
+        # largest value of the tags' type is never a tag, so it marks the
+        # empty cells
+        dtype = self.model.domains.dtype
+        empty = np.iinfo(dtype).max
+        if self.shared and not uniform:
+            slab = SharedSlab(shape, dtype=dtype)
+            grid = slab.grid
+        else:
+            slab = None
+            grid = np.empty(shape, dtype=dtype)
+        grid.fill(empty)
+        grid[z, y, x] = domains
+        if (grid == empty).any():
+            if slab is not None:
+                grid = None
+                slab.release()
+            return 0, None
+        
+        # find the parent blocks with a single domain, which are created as
+        # a single block instead of a block for every cell
+        if uniform:
+            single = np.ones((num_pbs_y, num_pbs_x), dtype=np.bool_)
+        else:
+            pb_grid = grid.reshape(
+                pb_size.z, num_pbs_y, pb_size.y, num_pbs_x, pb_size.x)
+            single = pb_grid.min(axis=(0, 2, 4)) == pb_grid.max(axis=(0, 2, 4))
+        
+        pbs = []
+        for y in range(num_pbs_y):
+            for x in range(num_pbs_x):
+                position = Position(x * pb_size.x, y * pb_size.y, z_start)
+                tags = grid[:, y * pb_size.y:(y + 1) * pb_size.y, x * pb_size.x:(x + 1) * pb_size.x]   # noqa
+                if single[y, x]:
+                    pb = ArrayParentBlock.uniform(
+                        pb_size, position, tags[0, 0, 0])
+                else:
+                    pb = ArrayParentBlock.from_tags(
+                        pb_size, position, tags, copy=False)
+                    pb.slab = slab
+                pbs.append(pb)
+        
+        if slab is not None and single.all():
+            # every parent block has a single domain, so it isn't needed
+            grid = tags = pb_grid = None
+            slab.release()
+        return num_blocks, pbs
+    
+    def _parse_slab(self, slab):
+        """
+        Parses rows of the form "x, y, z, size_x, size_y, size_z, domain" with
+        vectorised operations. Each row in slab must end with a newline.
+        
+        Returns:
+            A tuple of an (n, 3) array of the coordinates, an (n, 3) array of
+            the sizes and an array of n domain tags, or None if the rows are
+            not in the expected format
+        """
+        buf = np.frombuffer(slab, dtype=np.uint8)
+        if b'"' in slab:
+            return None     # leave any quoting to the csv reader
+        newlines = np.flatnonzero(buf == ord('\n'))
+        commas = np.flatnonzero(buf == ord(','))
+        num_rows = len(newlines)
+        
+        # every row must have exactly 6 commas
+        if len(commas) != 6 * num_rows:
+            return None
+        commas = commas.reshape(num_rows, 6)
+        starts = np.empty(num_rows, dtype=newlines.dtype)
+        starts[0] = 0
+        starts[1:] = newlines[:-1] + 1
+        if (commas[:, 0] < starts).any() or (commas[:, 5] > newlines).any():
+            return None
+        
+        # parse the 6 integer fields, which each end at a comma. The digits
+        # are read backwards from the comma, 1 position at a time for all the
+        # fields at once, until a digit isn't found.
+        ends = commas.ravel()
+        field_starts = np.empty_like(commas)
+        field_starts[:, 0] = starts
+        field_starts[:, 1:] = commas[:, :-1] + 1
+        field_starts = field_starts.ravel()
+        
+        values = np.zeros(len(ends), dtype=np.int64)
+        num_digits = np.zeros(len(ends), dtype=np.int64)
+        in_number = np.ones(len(ends), dtype=np.bool_)
+        for i in range(1, int((ends - field_starts).max()) + 1):
+            index = ends - i
+            digits = buf[np.maximum(index, 0)] - ord('0')
+            in_number &= (index >= field_starts) & (digits < 10)
+            if not in_number.any():
+                break
+            if i > MAX_DIGITS:
+                return None
+            values += np.where(in_number, digits, 0) * POWERS_OF_10[i - 1]
+            num_digits += in_number
+        
+        # there must be a number in every field, with only spaces before it.
+        # The padding is checked 1 position at a time from the field starts
+        number_starts = ends - num_digits
+        if not num_digits.all():
+            return None
+        for i in range(int((number_starts - field_starts).max())):
+            index = field_starts + i
+            if (buf[index[index < number_starts]] != ord(' ')).any():
+                return None
+        values = values.reshape(num_rows, 6)
+        
+        # the domain is everything after the last comma, except the line ending
+        domain_ends = newlines - (buf[newlines - 1] == ord('\r'))
+        names = _gather(buf, commas[:, 5] + 1, domain_ends, 0)
+        if names.shape[1] <= 8:
+            # compare short names as integers, which is much quicker
+            names = np.pad(names, ((0, 0), (0, 8 - names.shape[1])))
+            names = names.view(np.uint64).ravel()
+            unique_names, inverse = np.unique(names, return_inverse=True)
+            unique_names = [n.tobytes().rstrip(b'\0') for n in unique_names]
+            tags = self.model.domains.intern_all(unique_names)[inverse.ravel()]
+        else:
+            names = names.view('S{}'.format(names.shape[1])).ravel()
+            tags = self.model.domains.intern_all(names)
+        
+        return values[:, 0:3], values[:, 3:6], tags
                     
     def write(self):
         """
@@ -147,18 +453,56 @@ class CSVParser:
         they were read. However all the blocks from 1 parent block will be
         written before blocks from another parent block.
         """
-        while self.model:
-            pb = self.model.pop()
-            for block in pb:
-                # get the domain name from the tag
-                domain = self.model.get_domain_name(block.domain)
-            
-                self.writer.writerow(
-                    (block.position.x + pb.position.x,
-                        block.position.y + pb.position.y,
-                        block.position.z + pb.position.z,
-                        block.size.x,
-                        block.size.y,
-                        block.size.z,
-                        domain
-                     ))
+        parent_blocks = self.model.parent_blocks
+        self.model.parent_blocks = []
+        self.write_slice(parent_blocks)
+        
+    @instrumentation.timed('write')
+    @tracing.traced('write', lambda self, parent_blocks: {
+        'slab': tracing.slab_index(parent_blocks[0]) if parent_blocks
+        else None})
+    def write_slice(self, parent_blocks):
+        """
+        Writes a list of parent blocks as CSV values to the output file. The
+        parent blocks are written from the end of the list, in the same order
+        as write() removes them from the model.
+        
+        All the rows are formatted into a single buffer, which is written to
+        the output at once. The size and domain part of each row is cached, as
+        most blocks share only a few sizes. The SharedSlabs holding the tags
+        of the parent blocks are released once the rows are formatted.
+        """
+        out = bytearray()
+        row_endings = self.row_endings
+        encoded_names = self.model.domains.encoded_names
+        
+        for pb in reversed(parent_blocks):
+            if isinstance(pb, ArrayParentBlock):
+                positions, sizes, tags = pb.block_arrays()
+                positions = positions + np.array(pb.position)[:, None]
+                rows = zip(*positions.tolist(), *sizes.tolist(), tags.tolist())
+            else:
+                rows = ((block.position.x + pb.position.x,
+                         block.position.y + pb.position.y,
+                         block.position.z + pb.position.z,
+                         block.size.x,
+                         block.size.y,
+                         block.size.z,
+                         block.domain
+                         ) for block in pb)
+                
+            for x, y, z, size_x, size_y, size_z, tag in rows:
+                key = (size_x, size_y, size_z, tag)
+                try:
+                    ending = row_endings[key]
+                except KeyError:
+                    ending = b'%d,%d,%d,%s\r\n' % (
+                        size_x, size_y, size_z, encoded_names[tag])
+                    row_endings[key] = ending
+                out += b'%d,%d,%d,' % (x, y, z)
+                out += ending
+        release_slabs(parent_blocks)
+        
+        self.out_bytes.write(out)
+        if instrumentation.enabled:
+            instrumentation.count('blocks_out', out.count(b'\n'))
@@ -0,0 +1,167 @@
+"""
+A module for compressing a model within a time budget. The compression level
+of each slice is picked from how long the slices so far have taken, so that
+the rest of the model is projected to finish within the budget. The level is
+lowered when the compression is falling behind, and raised again, up to the
+level asked for, when it is ahead.
+
+Every level is lossless, so only the number of blocks written changes with
+the level, never the model they describe.
+"""
+
+import re
+import time
+
+# how much the time taken by each level is smoothed from one slice to the
+# next, from 0 for no smoothing to 1 to keep the first time forever
+SMOOTHING = 0.5
+
+# how many times longer a slice is guessed to take at the next level up,
+# before the time it takes at that level has been measured
+UPGRADE_COST = 4
+
+# the seconds in each unit of a duration
+_UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600}
+
+
+def duration(text):
+    """
+    Parses a duration, such as "90", "90s", "1.5m" or "2h", where a number
+    without a unit is in seconds.
+    
+    Returns the number of seconds
+    
+    Raises ValueError if the text isn't a positive duration
+    """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?|\.\d+)\s*([smh]?)\s*', text)
+    if match is None:
+        raise ValueError("not a duration: {!r}".format(text))
+    seconds = float(match.group(1)) * _UNITS[match.group(2)]
+    if seconds <= 0:
+        raise ValueError("the duration must be more than 0: {!r}".format(
+            text))
+    return seconds
+
+
+class Deadline:
+    """
+    Compresses the slices of a model with a CompressionEngine, picking the
+    compression level of each slice so the whole model is compressed within
+    a time budget.
+    
+    Before each slice, the time left is shared between the slices left, and
+    the highest level whose last slice took no longer than that share is
+    picked. A level which hasn't been used yet is guessed to take UPGRADE_COST
+    times as long as the level below it. So the compression drops a level at
+    a time while it is falling behind, and climbs back a level at a time while
+    it is ahead, but never above the level asked for.
+    
+    The budget can still be overrun, if even level 0 can't keep up or a single
+    slice takes longer than expected.
+    
+    Parameters:
+        engine      The CompressionEngine to compress the slices with
+        budget      The number of seconds to compress the whole model in,
+                    from when the deadline is created
+        num_slices  The number of slices in the model
+        max_level   The highest level to use, which is also the level of the
+                    first slice
+        min_level   The lowest level to use
+        clock       The function which gets the time in seconds
+    
+    The level used for each slice is appended to the levels attribute.
+    """
+    
+    def __init__(self, engine, budget, num_slices, max_level, min_level=0,
+                 clock=time.perf_counter):
+        super(Deadline, self).__init__()
+        self.engine = engine
+        self.budget = budget
+        self.num_slices = num_slices
+        self.max_level = max_level
+        self.min_level = min(min_level, max_level)
+        self.clock = clock
+        self.start = clock()
+        
+        # the smoothed number of seconds a slice takes at each level
+        self.seconds = {}
+        self.level = max_level
+        self.levels = []
+    
+    @classmethod
+    def for_parser(cls, engine, parser, budget, max_level, **parameters):
+        """
+        Creates a deadline for the model being read by the CSVParser, which
+        has the number of slices from the z size in the model's header.
+        """
+        model = parser.model
+        num_slices = model.size.z // model.parent_block_size.z
+        return cls(engine, budget, num_slices, max_level, **parameters)
+    
+    def _guess(self, level):
+        """
+        Gets the number of seconds a slice is expected to take at the level,
+        or None if no level at or below it has been measured
+        """
+        if level in self.seconds:
+            return self.seconds[level]
+        if level > self.min_level:
+            below = self._guess(level - 1)
+            if below is not None:
+                return below * UPGRADE_COST
+        return None
+    
+    def next_level(self):
+        """
+        Picks the level of the next slice, from the time left and the number
+        of slices left.
+        
+        Returns the level
+        """
+        done = len(self.levels)
+        slices_left = max(self.num_slices - done, 1)
+        share = (self.budget - (self.clock() - self.start)) / slices_left
+        
+        level = self.level
+        while level > self.min_level and self.seconds.get(level, 0) > share:
+            # falling behind, so try the next level down. Its time is
+            # measured on the next slice, if it hasn't been already
+            level -= 1
+            if level not in self.seconds:
+                break
+        
+        if level == self.level and level < self.max_level:
+            # ahead of schedule, if even the next level up fits
+            guess = self._guess(level + 1)
+            if guess is not None and guess <= share:
+                level += 1
+        
+        self.level = level
+        return level
+    
+    def record(self, level, seconds):
+        """Records the number of seconds a slice took at the level"""
+        if level in self.seconds:
+            seconds = SMOOTHING * self.seconds[level] + \
+                (1 - SMOOTHING) * seconds
+        self.seconds[level] = seconds
+        self.levels.append(level)
+    
+    def compress(self, parent_blocks):
+        """
+        Compresses the parent blocks of a slice with the engine, at the level
+        picked for the slice.
+        
+        Returns the list of compressed parent blocks
+        """
+        level = self.next_level()
+        started = self.clock()
+        parent_blocks = self.engine.compress(parent_blocks, level)
+        self.record(level, self.clock() - started)
+        return parent_blocks
+    
+    def run(self, model):
+        """
+        Compresses the parent blocks of the model, as a slice, see compress()
+        """
+        model.parent_blocks = self.compress(model.parent_blocks)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+A module for generating synthetic block models, for testing and benchmarking
+the compressor on models larger or stranger than the ones we have. The models
+are written in the same CSV format the CSVParser reads, with a header of the
+model and parent block sizes followed by a unit block for every cell, sorted
+by z, then y, then x.
+
+Each kind of model is a function which gives the domain of every cell in a
+range of z, so the model is generated and written 1 slice at a time and never
+has to fit in memory:
+    stratal         undulating layers of rock, like sedimentary strata
+    ore             ellipsoidal ore bodies at random angles, in waste rock
+    realistic       strata cut by ore bodies, with a sprinkling of noise
+    noise           a random domain in every cell
+    checkerboard    alternating domains in every direction, the worst case
+                    for every compressor
+"""
+
+import argparse
+import sys
+import numpy as np
+
+# the names of the domains of the layers of the stratal models, from the top
+STRATA = (
+    'air', 'soil', 'clay', 'sandstone', 'siltstone', 'shale', 'limestone',
+    'dolomite', 'basalt', 'granite'
+)
+
+# the domains of the noise models
+NOISE_DOMAINS = ('sea', 'NSW', 'NT', 'QLD', 'SA', 'TAS', 'VIC', 'WA')
+
+# the fraction of the cells given a random domain in the realistic models
+NOISE_FRACTION = 0.005
+
+
+def _grid(size, z0, z1):
+    """
+    Gets the x, y and z coordinates of the cells in the range of z, each as
+    an array indexed as [z, y, x]
+    """
+    return np.meshgrid(
+        np.arange(z0, z1), np.arange(size[1]), np.arange(size[0]),
+        indexing='ij')[::-1]
+
+
+def stratal(size, rng, layers=6):
+    """
+    Makes a model of undulating layers, where the top of each layer is a sum
+    of a few random waves across x and y.
+    
+    Returns the list of the domain names, and the function which gives the
+    index of the domain of each cell between 2 z coordinates
+    """
+    size_x, size_y, size_z = size
+    layers = min(layers, len(STRATA))
+    
+    # the depth of the top of each layer below the top of the model, with
+    # waves of a random wavelength, direction and phase
+    depths = np.sort(rng.uniform(0, size_z, layers - 1))
+    waves = []
+    for _ in range(layers - 1):
+        count = 3
+        waves.append((
+            rng.uniform(0.02, 0.15, count) * size_z,
+            rng.uniform(0, 2 * np.pi, count),
+            rng.uniform(size_x / 4 + 1, size_x + size_y, count),
+            rng.uniform(0, 2 * np.pi, count),
+        ))
+    
+    def domains(z0, z1):
+        x, y, z = _grid(size, z0, z1)
+        depth = size_z - 1 - z
+        labels = np.zeros(z.shape, dtype=np.int32)
+        for top, (amplitudes, angles, wavelengths, phases) in zip(
+                depths, waves):
+            surface = np.full(x.shape[1:], top)
+            for a, angle, wavelength, phase in zip(
+                    amplitudes, angles, wavelengths, phases):
+                along = x[0] * np.cos(angle) + y[0] * np.sin(angle)
+                surface = surface + a * np.sin(
+                    2 * np.pi * along / wavelength + phase)
+            labels += depth >= surface
+        return labels
+    
+    return list(STRATA[:layers]), domains
+
+
+def ore(size, rng, bodies=4, background=('waste',)):
+    """
+    Makes a model of ellipsoidal ore bodies of random sizes and angles, in a
+    background of waste rock. The background can also be another model, as
+    a tuple of its domain names and function.
+    
+    Returns the list of the domain names, and the function which gives the
+    index of the domain of each cell between 2 z coordinates
+    """
+    if len(background) == 2 and callable(background[1]):
+        names, background_domains = background
+    else:
+        names = list(background)
+        
+        def background_domains(z0, z1):
+            return np.zeros((z1 - z0, size[1], size[0]), dtype=np.int32)
+    
+    names = list(names)
+    ellipsoids = []
+    for i in range(bodies):
+        centre = rng.uniform(0, 1, 3) * size
+        radii = rng.uniform(0.05, 0.3, 3) * size + 1
+        
+        # a random rotation, from the QR decomposition of a random matrix
+        rotation, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+        ellipsoids.append((len(names), centre, radii, rotation))
+        names.append('ore{}'.format(i + 1))
+    
+    def domains(z0, z1):
+        labels = background_domains(z0, z1)
+        cells = np.stack(_grid(size, z0, z1), axis=-1) + 0.5
+        for label, centre, radii, rotation in ellipsoids:
+            local = (cells - centre) @ rotation
+            inside = (((local / radii) ** 2).sum(axis=-1)) <= 1
+            labels[inside] = label
+        return labels
+    
+    return names, domains
+
+
+def noise(size, rng, fraction=1.0, background=None):
+    """
+    Makes a model where a fraction of the cells have a random domain. The
+    rest of the cells are from the background model, as a tuple of its domain
+    names and function, or are the first noise domain if there is none.
+    
+    Returns the list of the domain names, and the function which gives the
+    index of the domain of each cell between 2 z coordinates
+    """
+    if background is None:
+        names = []
+        
+        def background_domains(z0, z1):
+            return np.zeros((z1 - z0, size[1], size[0]), dtype=np.int32)
+    else:
+        names, background_domains = background
+        names = list(names)
+    
+    # the noise domains come after those of the background
+    first = len(names)
+    names.extend(name for name in NOISE_DOMAINS if name not in names)
+    
+    def domains(z0, z1):
+        labels = background_domains(z0, z1)
+        mask = rng.random(labels.shape) < fraction
+        labels[mask] = rng.integers(first, len(names), np.count_nonzero(mask))
+        return labels
+    
+    return names, domains
+
+
+def realistic(size, rng):
+    """
+    Makes a model of strata cut by ore bodies, with a small fraction of the
+    cells given random domains.
+    
+    Returns the list of the domain names, and the function which gives the
+    index of the domain of each cell between 2 z coordinates
+    """
+    model = ore(size, rng, background=stratal(size, rng))
+    return noise(size, rng, NOISE_FRACTION, background=model)
+
+
+def checkerboard(size, rng):
+    """
+    Makes a model where every cell has a different domain to each of its
+    neighbours, so no 2 cells can share a block.
+    
+    Returns the list of the domain names, and the function which gives the
+    index of the domain of each cell between 2 z coordinates
+    """
+    def domains(z0, z1):
+        x, y, z = _grid(size, z0, z1)
+        return ((x + y + z) % 2).astype(np.int32)
+    
+    return ['black', 'white'], domains
+
+
+# the functions that make each kind of model
+KINDS = {
+    'stratal': stratal,
+    'ore': ore,
+    'realistic': realistic,
+    'noise': noise,
+    'checkerboard': checkerboard,
+}
+
+
+def generate(kind, size, parent_block_size, out_file=sys.stdout, seed=0):
+    """
+    Generates a model and writes it to the file in CSV format, 1 parent block
+    slice at a time.
+    
+    Parameters:
+        kind                The name of the kind of model, from KINDS
+        size                The number of cells in the model in x, y and z
+        parent_block_size   The size of the parent blocks in x, y and z
+        out_file            The text file to write to. It defaults to STDOUT
+        seed                The seed of the random numbers, so the same model
+                            is generated every time
+    
+    Returns the number of blocks written
+    
+    Raises ValueError if the kind is unknown, or a size isn't a multiple of
+    the parent block size
+    """
+    if kind not in KINDS:
+        raise ValueError("unknown kind of model: {}".format(kind))
+    for n, p in zip(size, parent_block_size):
+        if n <= 0 or p <= 0 or n % p:
+            raise ValueError(
+                "the model size {} isn't a multiple of the parent block size "
+                "{}".format(tuple(size), tuple(parent_block_size)))
+    
+    size = np.array(size)
+    rng = np.random.default_rng(seed)
+    names, domains = KINDS[kind](size, rng)
+    
+    # each row is the x and y of a cell, then z, then the size and domain
+    size_x, size_y, size_z = (int(n) for n in size)
+    prefixes = [
+        '{}, {}, '.format(x, y) for y in range(size_y) for x in range(size_x)]
+    endings = [", 1, 1, 1, '{}'\r\n".format(name) for name in names]
+    
+    write = out_file.write
+    write('# {}, {}, {}, {}, {}, {}\r\n'.format(
+        size_x, size_y, size_z, *parent_block_size))
+    step = parent_block_size[2]
+    for z0 in range(0, size_z, step):
+        labels = domains(z0, z0 + step)
+        for z in range(z0, z0 + step):
+            cells = labels[z - z0].ravel().tolist()
+            middle = str(z)
+            write(''.join([
+                prefix + middle + endings[label]
+                for prefix, label in zip(prefixes, cells)]))
+    return size_x * size_y * size_z
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generates a synthetic block model and writes it to "
+                    "STDOUT, in the format ModularCompressor.py reads"
+    )
+    parser.add_argument(
+        "kind",
+        help="the kind of model",
+        choices=sorted(KINDS)
+    )
+    parser.add_argument(
+        "--size",
+        help="the number of cells in the model in x, y and z (default: "
+             "%(default)s)",
+        type=int,
+        nargs=3,
+        metavar=("X", "Y", "Z"),
+        default=[64, 64, 40]
+    )
+    parser.add_argument(
+        "--parent-block-size",
+        help="the size of the parent blocks in x, y and z (default: "
+             "%(default)s)",
+        type=int,
+        nargs=3,
+        metavar=("X", "Y", "Z"),
+        default=[8, 8, 5]
+    )
+    parser.add_argument(
+        "--seed",
+        help="the seed of the random numbers (default: %(default)s)",
+        type=int,
+        default=0
+    )
+    return parser, parser.parse_args()
+
+
+def main():
+    parser, args = parse_args()
+    out_file = open(sys.stdout.fileno(), 'w', newline='', closefd=False)
+    try:
+        generate(
+            args.kind, args.size, args.parent_block_size, out_file, args.seed)
+    except ValueError as error:
+        parser.error(str(error))
+    finally:
+        out_file.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+A module for measuring where the time goes in a run. The time spent in each
+stage, such as parsing a slice, compressing a parent block with a compressor
+or writing a slice, is added up along with the number of times it ran, and
+counters can be added to for anything else, such as the blocks in and out of
+each compressor.
+
+Nothing is recorded until enable() is called, and while it is disabled
+stage() returns a shared context manager that does nothing, so leaving the
+stages in the code costs next to nothing.
+
+Each worker process records its own stages. The engine collects them with the
+results of each batch, see run_recorded(), and merges them into the stages of
+the main process, so report() covers the whole run.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# whether the stages and counters are being recorded
+enabled = False
+
+# the stages, by name, as lists of the number of calls, the wall time and the
+# CPU time of the thread, in seconds
+stages = {}
+
+# the counters, by name
+counters = {}
+
+# the ids of the processes whose stages have been recorded
+processes = set()
+
+# the stages are recorded from the pipeline's threads at once
+_lock = threading.Lock()
+
+# returned by stage() while disabled
+_NOTHING = nullcontext()
+
+# when recording started, for the total time of the run
+_started = None
+
+
+class _Stage:
+    """A context manager which records the time spent in a stage"""
+    
+    __slots__ = ('name', 'wall', 'cpu')
+    
+    def __init__(self, name):
+        self.name = name
+    
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        add(self.name, time.perf_counter() - self.wall,
+            time.thread_time() - self.cpu)
+        return False
+
+
+def enable():
+    """Starts recording the stages and counters"""
+    global enabled, _started
+    enabled = True
+    if _started is None:
+        _started = time.perf_counter()
+
+
+def disable():
+    """Stops recording the stages and counters, keeping those recorded"""
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Forgets all the stages and counters recorded"""
+    global _started
+    with _lock:
+        stages.clear()
+        counters.clear()
+        processes.clear()
+    _started = time.perf_counter() if enabled else None
+
+
+def stage(name):
+    """
+    Gets a context manager which records the time spent in the stage with
+    the name, e.g.
+        with instrumentation.stage('parse'):
+            ...
+    """
+    if not enabled:
+        return _NOTHING
+    return _Stage(name)
+
+
+def timed(name):
+    """A decorator which records each call of a function as a stage"""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(name, wall, cpu=0.0, calls=1):
+    """Adds the time of calls to a stage"""
+    with _lock:
+        entry = stages.get(name)
+        if entry is None:
+            stages[name] = [calls, wall, cpu]
+        else:
+            entry[0] += calls
+            entry[1] += wall
+            entry[2] += cpu
+        processes.add(os.getpid())
+
+
+def count(name, n=1):
+    """Adds to the counter with the name, if recording is enabled"""
+    if enabled:
+        with _lock:
+            counters[name] = counters.get(name, 0) + n
+
+
+def snapshot():
+    """
+    Gets the stages and counters recorded, in a form that can be sent
+    between processes and given to merge()
+    """
+    with _lock:
+        return ({name: list(entry) for name, entry in stages.items()},
+                dict(counters), set(processes))
+
+
+def merge(recorded):
+    """Adds stages and counters from snapshot() to those of this process"""
+    recorded_stages, recorded_counters, recorded_processes = recorded
+    for name, (calls, wall, cpu) in recorded_stages.items():
+        add(name, wall, cpu, calls)
+    with _lock:
+        for name, n in recorded_counters.items():
+            counters[name] = counters.get(name, 0) + n
+        processes.update(recorded_processes)
+
+
+def run_recorded(function, *args):
+    """
+    Runs a function in a worker process, recording its stages.
+    
+    Returns a tuple of the function's result and the snapshot() of the stages
+    and counters it recorded
+    """
+    enable()
+    reset()
+    try:
+        with _Stage('worker.' + function.__name__):
+            result = function(*args)
+        return result, snapshot()
+    finally:
+        reset()
+
+
+def summary():
+    """
+    Gets a summary of everything recorded, as a dict that can be saved as
+    JSON. The stages are sorted by the wall time spent in them.
+    """
+    recorded_stages, recorded_counters, recorded_processes = snapshot()
+    ordered = sorted(
+        recorded_stages.items(), key=lambda item: item[1][1], reverse=True)
+    return {
+        'wall_seconds': None if _started is None
+        else time.perf_counter() - _started,
+        'processes': len(recorded_processes),
+        'stages': {
+            name: {'calls': calls, 'wall_seconds': wall, 'cpu_seconds': cpu}
+            for name, (calls, wall, cpu) in ordered
+        },
+        'counters': dict(sorted(recorded_counters.items())),
+    }
+
+
+def report(out_file):
+    """Writes the summary() to a text file as JSON"""
+    json.dump(summary(), out_file, indent=2)
+    out_file.write('\n')
+    out_file.flush()
@@ -1,10 +1,24 @@
 from collections import namedtuple
 from enum import IntEnum, unique
+import csv
+import io
 import math
+import numpy as np
 
 Size = namedtuple('Size', ['x', 'y', 'z'])
 Position = namedtuple('Position', ['x', 'y', 'z'])
 
+# the largest domain tag that fits in the uint16 grids of tags
+UINT16_MAX = np.iinfo(np.uint16).max
+
+
+def tag_dtype(largest):
+    """
+    Gets the type of the grids of domain tags up to the largest tag. Tags are
+    uint16, unless there are too many domains, when they are uint32.
+    """
+    return np.uint16 if largest <= UINT16_MAX else np.uint32
+
 
 @unique
 class Direction(IntEnum):
@@ -27,23 +41,18 @@ class Model:
     def __init__(self):
         super(Model, self).__init__()
         self.parent_blocks = []
-        self.domains = []
+        self.domains = DomainInterner()
         self.size = None
         self.parent_block_size = None
             
     def get_domain_tag(self, domain_name):
         """Gets the integer tag that corresponds to the domain"""
-        try:
-            return self.domains.index(domain_name)
-        except ValueError:
-            # the domain is not in the list, add it
-            self.domains.append(domain_name)
-            return len(self.domains) - 1
+        return self.domains.intern(domain_name)
         
     def get_domain_name(self, tag):
         """Gets the domain for the integer tag"""
         try:
-            return self.domains[tag]
+            return self.domains.names[tag]
         except IndexError:
             return ""
         
@@ -74,6 +83,80 @@ class Model:
         return iter(self.parent_blocks)
 
 
+class DomainInterner:
+    """
+    The mapping between the domain names and the integer domain tags. Each new
+    domain name is given the next tag, starting from 0. The names are looked
+    up in a dict, so finding a tag doesn't depend on the number of domains.
+    
+    The interner also holds the encoded bytes of each domain, as they are
+    written in the CSV output. That way the writer never needs to format or
+    quote a domain name itself.
+    
+    Attributes:
+        tags            The dict from the domain names to their tags
+        names           The list of domain names, indexed by tag
+        encoded_names   The list of encoded domain names, indexed by tag
+        dtype           The type of the arrays of tags, which leaves its
+                        largest value free, see tag_dtype()
+    """
+    
+    def __init__(self):
+        super(DomainInterner, self).__init__()
+        self.tags = {}
+        self.names = []
+        self.encoded_names = []
+        
+    def intern(self, domain_name):
+        """Gets the tag for the domain, adding the domain if it is new"""
+        try:
+            return self.tags[domain_name]
+        except KeyError:
+            # the domain hasn't been seen before, add it
+            tag = len(self.names)
+            self.tags[domain_name] = tag
+            self.names.append(domain_name)
+            self.encoded_names.append(self._encode(domain_name))
+            return tag
+            
+    def intern_all(self, domain_names):
+        """
+        Gets the tags for an array of domains, adding any domains that are
+        new. The domains can be given as str or UTF-8 encoded bytes.
+        
+        Returns:
+            An array of the domain tags
+        """
+        unique_names, inverse = np.unique(domain_names, return_inverse=True)
+        lookup = np.array([
+            self.intern(n.decode() if isinstance(n, bytes) else str(n))
+            for n in unique_names.tolist()
+        ], dtype=np.int64)
+        return lookup.astype(self.dtype)[inverse.ravel()]
+    
+    @property
+    def dtype(self):
+        """
+        Gets the type of the arrays of tags. The largest value of the type is
+        never a tag, so it can mark a cell without a domain.
+        """
+        return tag_dtype(len(self.names))
+    
+    def __len__(self):
+        """Gets the number of domains"""
+        return len(self.names)
+        
+    @staticmethod
+    def _encode(domain_name):
+        """
+        Encodes the domain name as it is written by the csv module, which
+        quotes the name if it contains a comma, quote or line ending.
+        """
+        line = io.StringIO()
+        csv.writer(line, lineterminator='').writerow(('', domain_name))
+        return line.getvalue()[1:].encode()
+
+
 class ParentBlock:
     """
     The ParentBlocks subdivide the model exactly with no remainder. Each Parent
@@ -117,14 +200,11 @@ class ParentBlock:
     
     def __len__(self):
         """
-        Gets the number of blocks in the parent_block. This is not actually
-        always accurate. It is only accurate after the parent block has been
-        cleared and a new block added. To be truly useful this function needs
-        to be updated to be more general.
-        
-        TODO: FIx this.
+        Gets the number of blocks in the parent_block. The list of blocks also
+        holds the Positions of the cells covered by combined blocks, which are
+        not counted.
         """
-        return len(self.blocks)
+        return sum(isinstance(b, Block) for b in self.blocks)
     
     # not sure how useful this is right now
     def __getitem__(self, coordinate):
@@ -162,6 +242,56 @@ class ParentBlock:
         return self.blocks[
             z * (self.size.x * self.size.y) + y * (self.size.x) + x]
             
+    def tag_grid(self):
+        """
+        Gets the domain tag of every cell of the parent block, as a grid
+        indexed as [z, y, x].
+        """
+        if len(self.blocks) == 1:
+            return np.full(
+                (self.size.z, self.size.y, self.size.x), self.blocks[0].domain)
+        
+        tags = np.empty(len(self.blocks), dtype=np.int64)
+        for index, b in enumerate(self.blocks):
+            if isinstance(b, Position):
+                b = self.get_block_or_position(*b)
+            tags[index] = b.domain
+        return tags.reshape(self.size.z, self.size.y, self.size.x)
+    
+    def block_arrays(self):
+        """
+        Gets all the blocks in the parent block as arrays. The positions and
+        sizes are (3, n) arrays with rows for x, y and z, and the tags are an
+        array of n domain tags. The blocks are in the same order as iterating
+        over the parent block.
+        """
+        blocks = list(self)
+        positions = np.array(
+            [b.position for b in blocks], dtype=np.int64).reshape(-1, 3).T
+        sizes = np.array(
+            [b.size for b in blocks], dtype=np.int64).reshape(-1, 3).T
+        return positions, sizes, np.array([b.domain for b in blocks])
+    
+    def set_blocks(self, positions, sizes, tags):
+        """
+        Replaces all the blocks in the parent block with the blocks given as
+        arrays. The positions and sizes are (3, n) arrays with rows for x, y
+        and z, and the tags are an array of n domain tags. The blocks must
+        cover the whole parent block without overlapping.
+        """
+        plane = self.size.x * self.size.y
+        blocks = [None] * (plane * self.size.z)
+        for (x, y, z), (sx, sy, sz), tag in zip(
+                positions.T.tolist(), sizes.T.tolist(), tags.tolist()):
+            origin = Position(x, y, z)
+            for k in range(z, z + sz):
+                for j in range(y, y + sy):
+                    start = k * plane + j * self.size.x + x
+                    blocks[start:start + sx] = [origin] * sx
+            blocks[z * plane + y * self.size.x + x] = Block(
+                Size(sx, sy, sz), origin, tag)
+        self.blocks = blocks
+            
     def combine_blocks(self, blocks):
         """
         Combines blocks to create a larger block. The new block will be the
@@ -261,6 +391,280 @@ class ParentBlockIter:
                 return b
 
 
+class ArrayParentBlock:
+    """
+    An alternative ParentBlock, which stores its blocks in NumPy arrays rather
+    than a list of Block objects. It supports the same methods as the
+    ParentBlock, so the compressors can use either one, but the compressors
+    can also work directly on the arrays to vectorise their inner loops.
+    
+    The storage consists of:
+        tags            A uint16 grid with the domain tag of every cell, or
+                        a uint32 grid if there are too many domains
+        owner           An int32 grid that maps every cell to the id of the
+                        block covering it, or -1 if no block covers it
+        block_sizes     The table of blocks, stored as a struct of arrays. Row
+                        0, 1 and 2 hold the x, y and z sizes of the blocks
+    
+    The id of a block is the flat index of the cell at its origin, so a block
+    is only ever stored at its origin and a size of 0 means that no block
+    starts at that cell. The grids are indexed as [z, y, x], which is the same
+    order as the rows of the input data. A cell costs 12 bytes, which is much
+    smaller than a Block with its Size and Position tuples.
+    """
+    
+    def __init__(self, size, position, dtype=np.uint16):
+        super(ArrayParentBlock, self).__init__()
+        self.size = size
+        self.position = position
+        
+        shape = (size.z, size.y, size.x)
+        num_cells = size.x * size.y * size.z
+        self.tags = np.zeros(shape, dtype=dtype)
+        self.owner = np.full(shape, -1, dtype=np.int32)
+        self.block_sizes = np.zeros((3, num_cells), dtype=np.uint16)
+        self.num_blocks = 0
+        
+        # the SharedSlab holding the tags of the slice, if there is one
+        self.slab = None
+    
+    @classmethod
+    def from_tags(cls, size, position, tags, copy=True):
+        """
+        Creates a parent block filled with unit sized blocks, from a grid of
+        domain tags indexed as [z, y, x]. If copy is False, the parent block
+        keeps the grid itself, such as a view of a SharedSlab, and only
+        copies it if a block is appended with append().
+        """
+        parent_block = cls(
+            size, position, np.promote_types(np.uint16, tags.dtype))
+        if copy:
+            parent_block.tags[...] = tags
+        else:
+            parent_block.tags = tags
+        parent_block.owner.flat = np.arange(parent_block.owner.size)
+        parent_block.block_sizes.fill(1)
+        parent_block.num_blocks = parent_block.owner.size
+        return parent_block
+    
+    @classmethod
+    def uniform(cls, size, position, domain):
+        """
+        Creates a parent block that is a single block of the domain, which is
+        the same as the compressed result of any parent block with only 1
+        domain.
+        """
+        parent_block = cls(size, position, tag_dtype(domain))
+        parent_block.tags.fill(domain)
+        parent_block.owner.fill(0)
+        parent_block.block_sizes[:, 0] = size
+        parent_block.num_blocks = 1
+        return parent_block
+    
+    def _index(self, x, y, z):
+        """Gets the flat index of the cell at the coordinate"""
+        return z * (self.size.x * self.size.y) + y * self.size.x + x
+    
+    def _block_at(self, index):
+        """Gets the Block whose origin is at the flat index"""
+        z, rest = divmod(index, self.size.x * self.size.y)
+        y, x = divmod(rest, self.size.x)
+        return Block(
+            size=Size(*self.block_sizes[:, index].tolist()),
+            position=Position(x, y, z),
+            domain=int(self.tags.flat[index])
+        )
+        
+    def append(self, block):
+        """Adds a block to this parent block"""
+        x, y, z = block.position
+        index = self._index(x, y, z)
+        if block.domain > UINT16_MAX and self.tags.dtype == np.uint16:
+            # too many domains for 16 bit tags
+            self.tags = self.tags.astype(np.uint32)
+        elif not self.tags.flags.owndata:
+            # the tags are a view of a grid shared with others
+            self.tags = self.tags.copy()
+        if block.size == (1, 1, 1):
+            # the common case when parsing, so skip building the slices
+            self.tags[z, y, x] = block.domain
+            self.owner[z, y, x] = index
+        else:
+            region = (
+                slice(z, z + block.size.z),
+                slice(y, y + block.size.y),
+                slice(x, x + block.size.x)
+            )
+            self.tags[region] = block.domain
+            self.owner[region] = index
+        self.block_sizes[:, index] = block.size
+        self.num_blocks += 1
+        
+    def clear(self):
+        """Clears (removes) all blocks from this parent block"""
+        self.owner.fill(-1)
+        self.block_sizes.fill(0)
+        self.num_blocks = 0
+        
+    def __iter__(self):
+        """
+        Returns an iterator over the blocks, in the same order as iterating
+        over a ParentBlock.
+        """
+        return ArrayParentBlockIter(self)
+    
+    def __len__(self):
+        """Gets the number of blocks in the parent block"""
+        return self.num_blocks
+    
+    def __getitem__(self, coordinate):
+        return self.get_block(*coordinate)
+    
+    def get_block(self, x, y, z):
+        """
+        Get the block that occupies the specified coordinates. The block may
+        not start at the specified location, but it will extend to occupy the
+        specified coordinate. If the coordinate is out of range of the parent-
+        block None is returned.
+        """
+        if x < 0 or x >= self.size.x or \
+            y < 0 or y >= self.size.y or \
+                z < 0 or z >= self.size.z:
+            return None
+        
+        index = int(self.owner[z, y, x])
+        if index < 0:
+            return None
+        return self._block_at(index)
+    
+    def get_block_or_position(self, x, y, z):
+        """
+        Get the block that starts at the specified location or the Position of
+        the block that occupies the specified location, in the event that a
+        block does not start at that location. None is returned if the
+        coordinate is outside of the parent-block
+        """
+        b = self.get_block(x, y, z)
+        if b is not None and b.position != (x, y, z):
+            return b.position
+        return b
+    
+    def combine_blocks(self, blocks):
+        """
+        Combines blocks to create a larger block. The new block will be the
+        bounding box of all the blocks supplied and have the domain of the
+        first block supplied. It is the user's resposibility to ensure that
+        combining the blocks is valid and makes sense.
+        """
+        combined_block = Block.combine(blocks)
+        
+        for b in blocks:
+            self.block_sizes[:, self._index(*b.position)] = 0
+        self.num_blocks -= len(blocks)
+        
+        self.append(combined_block)
+    
+    def get_neighbours(self, block, direction):
+        """
+        Get a list of all the neighbours of the block in the given Direction.
+        Neighbours of a block are any blocks that touch the face of the block
+        on the specified side. Only part of a block needs to touch the face
+        to be counted as a neighbour.
+        
+        Returns a set of neighbouring blocks
+        """
+        start = list(block.position)
+        end = [p + s for p, s in zip(block.position, block.size)]
+        
+        if direction == Direction.POS_X:
+            start[0] = end[0]
+            end[0] += 1
+        elif direction == Direction.POS_Y:
+            start[1] = end[1]
+            end[1] += 1
+        elif direction == Direction.POS_Z:
+            start[2] = end[2]
+            end[2] += 1
+        elif direction == Direction.NEG_X:
+            end[0] = start[0]
+            start[0] -= 1
+        elif direction == Direction.NEG_Y:
+            end[1] = start[1]
+            start[1] -= 1
+        elif direction == Direction.NEG_Z:
+            end[2] = start[2]
+            start[2] -= 1
+        
+        # the face is outside of the parent block
+        if min(start) < 0 or end[0] > self.size.x or \
+                end[1] > self.size.y or end[2] > self.size.z:
+            return set()
+        
+        face = self.owner[start[2]:end[2], start[1]:end[1], start[0]:end[0]]
+        return {self._block_at(i) for i in np.unique(face).tolist() if i >= 0}
+    
+    def tag_grid(self):
+        """
+        Gets the domain tag of every cell of the parent block, as a grid
+        indexed as [z, y, x].
+        """
+        return self.tags
+    
+    def set_blocks(self, positions, sizes, tags):
+        """
+        Replaces all the blocks in the parent block with the blocks given as
+        arrays, in the same form as returned by block_arrays(). The blocks
+        must be a partition of the parent block's cells, where each block has
+        the domain of its cells, so the tags of the cells are left as they
+        are.
+        """
+        self.clear()
+        x, y, z = positions.astype(np.int64)
+        origins = self._index(x, y, z)
+        self.block_sizes[:, origins] = sizes
+        for index, (x, y, z), (size_x, size_y, size_z) in zip(
+                origins.tolist(), positions.T.tolist(), sizes.T.tolist()):
+            self.owner[z:z + size_z, y:y + size_y, x:x + size_x] = index
+        self.num_blocks = len(origins)
+    
+    def block_arrays(self):
+        """
+        Gets all the blocks in the parent block as arrays. The positions and
+        sizes are (3, n) arrays with rows for x, y and z, and the tags are an
+        array of n domain tags. The blocks are in the same order as iterating
+        over the parent block.
+        """
+        origins = np.flatnonzero(self.block_sizes[0])
+        z, y, x = np.unravel_index(origins, self.owner.shape)
+        positions = np.stack((x, y, z))
+        return positions, self.block_sizes[:, origins], self.tags.flat[origins]
+
+
+class ArrayParentBlockIter:
+    """
+    An iterator over an ArrayParentBlock. Like the ParentBlockIter, blocks
+    combined during the iteration are seen by the iterator, so compressors can
+    change the parent block while they iterate over it.
+    """
+    
+    def __init__(self, parentblock):
+        super(ArrayParentBlockIter, self).__init__()
+        self.parentblock = parentblock
+        self.index = 0
+        
+    def __iter__(self):
+        return self
+        
+    def __next__(self):
+        sizes = self.parentblock.block_sizes[0]
+        while self.index < len(sizes):
+            index = self.index
+            self.index += 1
+            if sizes[index]:
+                return self.parentblock._block_at(index)
+        raise StopIteration
+
+
 class Block(namedtuple('Block', ['size', 'position', 'domain'])):
     """
     Lightweight representation of a block in the data model.
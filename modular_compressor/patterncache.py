@@ -0,0 +1,115 @@
+"""
+A module for caching the compressed blocks of parent blocks by the pattern of
+their domains. In stratified models the same pattern of domains repeats in
+many parent blocks, often with different domains, e.g. a layer of 'sea' over a
+layer of 'rock' has the same pattern as a layer of 'air' over a layer of
+'sea'. The compressors only depend on which cells share a domain, so the
+compressed blocks of one parent block can be reused for every parent block
+with the same pattern.
+
+Each worker process has its own cache, which is kept from one slice to the
+next, so the parent blocks which hit the cache are not compressed at all.
+"""
+
+from collections import OrderedDict
+import numpy as np
+from model import tag_dtype
+import instrumentation
+
+# the default number of patterns kept in a cache
+MAX_PATTERNS = 4096
+
+
+class PatternCache:
+    """
+    A least recently used cache of the compressed blocks of parent blocks,
+    keyed by the pattern of their domains. The domains of a parent block are
+    relabelled in the order they first appear in its cells, in [z, y, x]
+    order, so parent blocks with the same pattern but different domains have
+    the same key.
+    
+    The blocks are cached relative to the parent block, with the relabelled
+    domains, so they are the same for every parent block with the pattern.
+    
+    Parameters:
+        max_patterns    The number of patterns to keep. When the cache is
+                        full, the least recently used pattern is dropped.
+    
+    The number of lookups that found a pattern, and that didn't, are counted
+    in the hits and misses attributes.
+    """
+    
+    def __init__(self, max_patterns=MAX_PATTERNS):
+        super(PatternCache, self).__init__()
+        self.max_patterns = max_patterns
+        self.patterns = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+    
+    def __len__(self):
+        """Gets the number of patterns in the cache"""
+        return len(self.patterns)
+    
+    @staticmethod
+    def pattern(tags):
+        """
+        Finds the pattern of a grid of domain tags.
+        
+        Returns a tuple of the key of the pattern, the grid of the relabelled
+        domains, and the array of the domains in the order of their labels
+        """
+        domains, first, inverse = np.unique(
+            tags, return_index=True, return_inverse=True)
+        
+        # label the domains in the order they first appear
+        order = np.argsort(first)
+        labels = np.empty(len(order), dtype=tag_dtype(len(order) - 1))
+        labels[order] = np.arange(len(order))
+        labels = labels[inverse.reshape(tags.shape)]
+        
+        if len(domains) <= 256:
+            key_labels = labels.astype(np.uint8)
+        else:
+            key_labels = labels
+        key = (tags.shape, key_labels.tobytes())
+        return key, labels, domains[order]
+    
+    def compress(self, parent_block, compress):
+        """
+        Compresses a parent block with the blocks cached for its pattern. If
+        the pattern isn't in the cache, the parent block is compressed with
+        the function, and its blocks are cached.
+        
+        Parameters:
+            parent_block    The parent block to compress
+            compress        The function that compresses a parent block and
+                            returns the compressed parent block
+        
+        Returns the compressed parent block
+        """
+        key, labels, domains = self.pattern(parent_block.tag_grid())
+        
+        blocks = self.patterns.get(key)
+        if blocks is not None:
+            self.hits += 1
+            instrumentation.count('pattern_cache.hits')
+            self.patterns.move_to_end(key)
+            positions, sizes, block_labels = blocks
+            parent_block.set_blocks(positions, sizes, domains[block_labels])
+            return parent_block
+        
+        self.misses += 1
+        instrumentation.count('pattern_cache.misses')
+        parent_block = compress(parent_block)
+        
+        # every block has the domain of the cell at its origin
+        positions, sizes, _ = parent_block.block_arrays()
+        x, y, z = positions
+        block_labels = labels[z, y, x]
+        
+        self.patterns[key] = (
+            positions.astype(np.uint16), sizes.astype(np.uint16),
+            block_labels)
+        if len(self.patterns) > self.max_patterns:
+            self.patterns.popitem(last=False)
+        return parent_block
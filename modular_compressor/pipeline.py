@@ -0,0 +1,115 @@
+"""
+A module that runs the reading, compressing and writing of the slices as a
+pipeline. While one slice is being compressed, the next slice is read and the
+previous slice is written, so the parsing and writing happen while the
+compression is using the processors.
+
+The reading and writing are each done in their own thread, and the slices are
+passed between the stages in bounded queues. So only a few slices are ever in
+memory at once, and the slices are always written in the order they were read.
+"""
+
+import queue
+import threading
+
+# placed in a queue to signal that there are no more slices
+_END = object()
+
+# how often the stages check if the pipeline has been stopped, in seconds
+_POLL_INTERVAL = 0.1
+
+
+def _put(slices, item, stop):
+    """
+    Puts an item in the queue, waiting until there is room. Gives up if the
+    pipeline is stopped while waiting.
+    
+    Returns True if the item was put in the queue
+    """
+    while True:
+        try:
+            slices.put(item, timeout=_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            if stop.is_set():
+                return False
+
+
+def _get(slices, stop):
+    """
+    Gets the next item from the queue, waiting until there is one. Returns
+    _END if the pipeline is stopped while waiting.
+    """
+    while True:
+        try:
+            return slices.get(timeout=_POLL_INTERVAL)
+        except queue.Empty:
+            if stop.is_set():
+                return _END
+
+
+def run(parser, compress, depth=1):
+    """
+    Reads, compresses and writes all of the slices of the model.
+    
+    Parameters:
+        parser      The CSVParser to read the slices from and write them to
+        compress    The function that compresses a list of parent blocks and
+                    returns the list of compressed parent blocks
+        depth       The number of slices that can wait between each stage
+    
+    Any exception raised in one of the stages stops the pipeline and is
+    raised again from this function.
+    """
+    to_compress = queue.Queue(maxsize=depth)
+    to_write = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+    
+    def read_stage():
+        try:
+            while not stop.is_set():
+                num_blocks, parent_blocks = parser.read_slice()
+                if num_blocks == 0:
+                    break
+                if not _put(to_compress, parent_blocks, stop):
+                    return
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+        _put(to_compress, _END, stop)
+    
+    def write_stage():
+        try:
+            while True:
+                parent_blocks = _get(to_write, stop)
+                if parent_blocks is _END:
+                    break
+                parser.write_slice(parent_blocks)
+        except BaseException as error:
+            errors.append(error)
+            stop.set()
+    
+    reader = threading.Thread(target=read_stage, name='read')
+    writer = threading.Thread(target=write_stage, name='write')
+    reader.start()
+    writer.start()
+    
+    # the compression is done in this thread
+    try:
+        while True:
+            parent_blocks = _get(to_compress, stop)
+            if parent_blocks is _END:
+                break
+            if not _put(to_write, compress(parent_blocks), stop):
+                break
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+    finally:
+        _put(to_write, _END, stop)
+        reader.join()
+        writer.join()
+    
+    if errors:
+        raise errors[0]
@@ -0,0 +1,211 @@
+"""
+A module for profiling a whole run, including the worker processes, which
+`python -m cProfile` can't see. Each worker profiles itself from when it
+starts, and saves its profile to a shared directory when the pool shuts it
+down. The profiles of the workers are then merged with the profile of the
+main process into a single pstats file, which can be read with pstats or
+tools like snakeviz.
+
+There are 2 kinds of profiler:
+    cprofile    cProfile, which records every call. It is exact, but slows
+                down the code it profiles, especially small functions
+    sampler     A statistical profiler, which looks at the stack of every
+                thread at a fixed interval. It costs far less, so it suits
+                long runs, but its call counts are the number of samples
+"""
+
+import cProfile
+import collections
+import marshal
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+from multiprocessing import util
+
+# the seconds between the samples of the sampler
+SAMPLE_INTERVAL = 0.005
+
+# the kinds of profiler
+KINDS = ('cprofile', 'sampler')
+
+
+class Sampler:
+    """
+    A statistical profiler, which samples the stack of every thread in the
+    process, except its own, every interval seconds. The stats it creates are
+    in the same form as cProfile's, where the time of each function is the
+    number of samples it was in times the interval, so the 2 can be used the
+    same way.
+    """
+    
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super(Sampler, self).__init__()
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.stats = {}
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def enable(self):
+        """Starts sampling, in a new thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name='sampler', daemon=True)
+            self._thread.start()
+    
+    def disable(self):
+        """Stops sampling"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+    
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        (code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                self.samples[tuple(stack)] += 1
+    
+    def create_stats(self):
+        """
+        Turns the samples into stats, like those of cProfile, in the stats
+        attribute
+        """
+        self.disable()
+        stats = {}
+        for stack, n in self.samples.items():
+            seconds = n * self.interval
+            seen = set()
+            for i, function in enumerate(stack):
+                entry = stats.get(function)
+                if entry is None:
+                    entry = stats[function] = [0, 0, 0.0, 0.0, {}]
+                own = seconds if i == 0 else 0.0
+                entry[2] += own
+                if function not in seen:
+                    # recursion only counts once towards the time inside
+                    seen.add(function)
+                    entry[0] += n
+                    entry[1] += n
+                    entry[3] += seconds
+                if i + 1 < len(stack):
+                    callers = entry[4]
+                    calls, prims, tt, ct = callers.get(
+                        stack[i + 1], (0, 0, 0.0, 0.0))
+                    callers[stack[i + 1]] = (
+                        calls + n, prims + n, tt + own, ct + seconds)
+        self.stats = {
+            function: tuple(entry) for function, entry in stats.items()}
+    
+    def dump_stats(self, path):
+        """Saves the stats to a file, which pstats can read"""
+        self.create_stats()
+        with open(path, 'wb') as file:
+            marshal.dump(self.stats, file)
+
+
+def _new_profiler(kind):
+    """Creates a profiler of the kind, "cprofile" or "sampler" """
+    if kind == 'cprofile':
+        return cProfile.Profile()
+    if kind == 'sampler':
+        return Sampler()
+    raise ValueError("unknown kind of profiler: {}".format(kind))
+
+
+def _save_worker_profile(profiler, directory):
+    """Saves the profile of a worker as it exits"""
+    profiler.disable()
+    profiler.dump_stats(
+        os.path.join(directory, 'worker-{}.prof'.format(os.getpid())))
+
+
+def start_worker(kind, directory):
+    """
+    Starts profiling a worker process, which saves its profile in the
+    directory when it exits. This is run by each worker as it starts.
+    """
+    profiler = _new_profiler(kind)
+    profiler.enable()
+    util.Finalize(None, _save_worker_profile, args=(profiler, directory),
+                  exitpriority=10)
+
+
+class Profiler:
+    """
+    Profiles the main process, and collects the profiles of the workers. The
+    profile of every thread of the main process is recorded, including those
+    started after start(). The workers are started with the worker_args,
+    see start_worker().
+    
+    Parameters:
+        path    The file to save the merged profile to
+        kind    The kind of profiler, "cprofile" or "sampler"
+    """
+    
+    def __init__(self, path, kind='cprofile'):
+        super(Profiler, self).__init__()
+        if kind not in KINDS:
+            raise ValueError("unknown kind of profiler: {}".format(kind))
+        self.path = path
+        self.kind = kind
+        self.directory = tempfile.mkdtemp(prefix='profile-')
+        self.worker_args = (kind, self.directory)
+        self.profilers = []
+        self._lock = threading.Lock()
+    
+    def _profile_thread(self, frame, event, arg):
+        """
+        Set as the profile function of new threads, to start a cProfile of
+        the thread the first time it is called
+        """
+        sys.setprofile(None)
+        profiler = cProfile.Profile()
+        with self._lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+    
+    def start(self):
+        """Starts profiling the main process"""
+        profiler = _new_profiler(self.kind)
+        self.profilers.append(profiler)
+        if self.kind == 'cprofile':
+            # cProfile only profiles the thread it is enabled in
+            threading.setprofile(self._profile_thread)
+        profiler.enable()
+    
+    def stop(self):
+        """
+        Stops profiling the main process, and saves the merged profile of it
+        and the workers which have exited
+        """
+        threading.setprofile(None)
+        for profiler in self.profilers:
+            profiler.disable()
+        
+        merged = pstats.Stats()
+        workers = [
+            os.path.join(self.directory, name)
+            for name in sorted(os.listdir(self.directory))]
+        for source in self.profilers + workers:
+            try:
+                merged.add(source)
+            except TypeError:
+                # nothing was recorded
+                pass
+        merged.dump_stats(self.path)
+        self.profilers = []
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return merged
@@ -0,0 +1,95 @@
+"""
+A module that decides how the parent blocks of a slice are shared out between
+the worker processes. The cost of compressing each parent block is estimated
+from the number of faces between cells of different domains, which is cheap
+to count for a whole slice at once.
+
+Parent blocks with only 1 domain have no such faces, and are so cheap to
+compress that they are kept in the main process. The rest are sorted from the
+most to the least expensive and grouped into batches. The batches start small
+and grow as the work left shrinks, so the expensive parent blocks are started
+first and the workers all finish at about the same time.
+"""
+
+import numpy as np
+from model import ArrayParentBlock
+
+# the smallest estimated cost of a batch, so that cheap parent blocks are sent
+# to the workers in groups rather than 1 at a time
+MIN_BATCH_COST = 2000
+
+# the estimated cost of sending a parent block to a worker, in faces
+DISPATCH_COST = 50
+
+
+def estimate_costs(parent_blocks):
+    """
+    Estimates the cost of compressing each parent block. For ArrayParentBlocks
+    this is the number of faces between neighbouring cells with different
+    domains. Otherwise it is the number of blocks, less 1.
+    
+    Returns an array of the costs, where a cost of 0 means the parent block
+    contains a single domain.
+    """
+    costs = np.zeros(len(parent_blocks), dtype=np.int64)
+    
+    # the tags of all the ArrayParentBlocks of the same size are stacked, so
+    # the faces of all of them are counted at once
+    groups = {}
+    for i, pb in enumerate(parent_blocks):
+        if isinstance(pb, ArrayParentBlock):
+            groups.setdefault(pb.tags.shape, []).append(i)
+        else:
+            costs[i] = max(len(pb) - 1, 0)
+    
+    for indexes in groups.values():
+        tags = np.stack([parent_blocks[i].tags for i in indexes])
+        faces = np.count_nonzero(tags[:, 1:] != tags[:, :-1], axis=(1, 2, 3))
+        faces += np.count_nonzero(
+            tags[:, :, 1:] != tags[:, :, :-1], axis=(1, 2, 3))
+        faces += np.count_nonzero(
+            tags[:, :, :, 1:] != tags[:, :, :, :-1], axis=(1, 2, 3))
+        costs[indexes] = faces
+    
+    return costs
+
+
+def plan(parent_blocks, num_workers):
+    """
+    Plans which parent blocks to compress in the main process, and how to
+    batch the rest for the workers.
+    
+    Returns:
+        A tuple of the list of indexes of the parent blocks to compress in
+        the main process, and the list of batches for the workers. Each batch
+        is a list of indexes of parent blocks. The batches are in the order
+        they should be started.
+    """
+    costs = estimate_costs(parent_blocks)
+    local = np.flatnonzero(costs == 0).tolist()
+    
+    # the most expensive parent blocks first
+    remote = np.flatnonzero(costs)
+    remote = remote[np.argsort(-costs[remote], kind='stable')]
+    remote_costs = costs[remote] + DISPATCH_COST
+    
+    batches = []
+    remaining = int(remote_costs.sum())
+    batch = []
+    batch_cost = 0
+    target = 0
+    for index, cost in zip(remote.tolist(), remote_costs.tolist()):
+        if not batch:
+            # guided scheduling, each batch is a share of the work left
+            target = max(remaining // (2 * num_workers), MIN_BATCH_COST)
+        batch.append(index)
+        batch_cost += cost
+        remaining -= cost
+        if batch_cost >= target:
+            batches.append(batch)
+            batch = []
+            batch_cost = 0
+    if batch:
+        batches.append(batch)
+    
+    return local, batches
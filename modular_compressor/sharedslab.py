@@ -0,0 +1,117 @@
+"""
+A module for passing the domain tags of a slice to the worker processes
+through shared memory, instead of pickling the parent blocks. The parser
+places the tags of the whole slice in a SharedSlab, and the parent blocks of
+the slice, in the parser and in the workers, hold views of it rather than
+copies of their tags.
+"""
+
+from multiprocessing import resource_tracker, shared_memory
+import os
+import numpy as np
+
+# the number of slabs a worker keeps attached before closing the oldest
+MAX_ATTACHED = 4
+
+# the slabs attached in this process, by the name of their shared memory
+_attached = {}
+
+
+class SharedSlab:
+    """
+    A grid of the domain tags for a whole slice, indexed as [z, y, x], held in
+    shared memory. When a SharedSlab is pickled only the name of the shared
+    memory and the shape of the grid are sent, and the receiving process
+    attaches to the same memory.
+
+    The process that creates the slab must call release() once no process
+    needs the slab anymore. The parser does this once the slice is written.
+
+    Parameters:
+        shape   The shape of the grid
+        name    The name of existing shared memory to attach to. If it is
+                None, new shared memory is created.
+        dtype   The type of the tags, see model.tag_dtype()
+    """
+
+    def __init__(self, shape, name=None, dtype=np.uint16):
+        super(SharedSlab, self).__init__()
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        if name is None:
+            size = max(int(np.prod(self.shape)), 1) * self.dtype.itemsize
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.grid = np.ndarray(
+            self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    def __reduce__(self):
+        return (attach, (self.name, self.shape, self.dtype.str))
+
+    def parent_block_tags(self, parent_block_size, position):
+        """
+        Gets a view of the tags of the parent block at the position, where
+        the position is in model coordinates.
+        """
+        return self.grid[
+            :,
+            position.y:position.y + parent_block_size.y,
+            position.x:position.x + parent_block_size.x
+        ]
+
+    def close(self):
+        """
+        Closes this process's access to the shared memory. If parent blocks
+        still hold views of the grid, the memory is unmapped once they're
+        gone instead.
+        """
+        self.grid = None
+        try:
+            self.memory.close()
+        except BufferError:
+            pass
+
+    def release(self):
+        """Closes and frees the shared memory, once it's no longer needed"""
+        self.memory.unlink()
+        self.close()
+
+
+def attach(name, shape, dtype=np.uint16):
+    """
+    Gets the slab with the shared memory name. A slab is only attached once in
+    each process, and the oldest slabs are closed as new ones are attached.
+    """
+    try:
+        return _attached[name]
+    except KeyError:
+        pass
+
+    while len(_attached) >= MAX_ATTACHED:
+        _attached.pop(next(iter(_attached))).close()
+    slab = SharedSlab(shape, name=name, dtype=dtype)
+    _attached[name] = slab
+    return slab
+
+
+def release_slabs(parent_blocks):
+    """Releases the SharedSlabs of the parent blocks, once they're written"""
+    slabs = {}
+    for pb in parent_blocks:
+        if getattr(pb, 'slab', None) is not None:
+            slabs[pb.slab.name] = pb.slab
+    for slab in slabs.values():
+        slab.release()
+
+
+def prepare_workers():
+    """
+    Starts the tracker of shared memory in this process. This must be done
+    before starting worker processes that attach to slabs, so the workers
+    share this tracker. Otherwise each worker starts its own tracker, which
+    reports the slabs the worker attached to as leaked when it exits.
+    """
+    if os.name == 'posix':
+        resource_tracker.ensure_running()
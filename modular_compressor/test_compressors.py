@@ -0,0 +1,131 @@
+"""
+Tests of the compressors' partitions, run with pytest from this directory.
+"""
+
+import numpy as np
+import pytest
+from model import ArrayParentBlock, Block, ParentBlock, Position, Size
+from compressors.GreedyExpander import GreedyExpander
+from compressors.MaximalCuboid import MaximalCuboid
+from compressors.OptimalPartitioner import OptimalPartitioner
+from compressors.Octree import Octree
+from compressors.RunLength import RunLength
+from compressors.compressor import lower_bound
+
+# the seeds of the random grids of domain tags
+SEEDS = range(40)
+
+
+def random_tags(seed, max_size=6):
+    """
+    Makes a random grid of domain tags, indexed as [z, y, x], with patches of
+    a few domains so the blocks have something to grow over.
+    """
+    rng = np.random.default_rng(seed)
+    shape = tuple(rng.integers(1, max_size + 1, 3))
+    num_domains = int(rng.integers(1, 5))
+    tags = rng.integers(0, num_domains, shape).astype(np.uint16)
+    # patches of a single domain
+    for _ in range(int(rng.integers(0, 4))):
+        z, y, x = (int(rng.integers(0, n)) for n in shape)
+        tags[z:z + 3, y:y + 3, x:x + 3] = rng.integers(0, num_domains)
+    return tags
+
+
+def rows(blocks):
+    """Gets the blocks given as arrays as a sorted list of tuples"""
+    positions, sizes, tags = blocks
+    return sorted(zip(*np.asarray(positions).tolist(),
+                      *np.asarray(sizes).tolist(), np.asarray(tags).tolist()))
+
+
+def check_partition(tags, blocks):
+    """
+    Checks that the blocks cover every cell of the grid exactly once, and
+    that every block has a single domain, which it is tagged with.
+    """
+    covered = np.zeros(tags.shape, dtype=np.int64)
+    for x, y, z, size_x, size_y, size_z, tag in rows(blocks):
+        region = (slice(z, z + size_z), slice(y, y + size_y),
+                  slice(x, x + size_x))
+        assert size_x > 0 and size_y > 0 and size_z > 0
+        assert (tags[region] == tag).all()
+        covered[region] += 1
+    assert (covered == 1).all()
+
+
+def unit_parent_block(tags):
+    """Makes a ParentBlock of a unit sized Block for every cell"""
+    size_z, size_y, size_x = tags.shape
+    parent_block = ParentBlock(Size(size_x, size_y, size_z), Position(0, 0, 0))
+    for z in range(size_z):
+        for y in range(size_y):
+            for x in range(size_x):
+                parent_block.append(Block(
+                    Size(1, 1, 1), Position(x, y, z), int(tags[z, y, x])))
+    return parent_block
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_greedy_grid_matches_neighbours(seed):
+    """
+    Growing the blocks on the grid gives the same blocks as merging the
+    neighbours of each block with _suck_in_the_blocks()
+    """
+    tags = random_tags(seed)
+    greedy = GreedyExpander()
+    expected = greedy._compress_by_neighbours(unit_parent_block(tags))
+    assert rows(greedy.partition(tags)) == rows(expected.block_arrays())
+
+
+def test_greedy_long_runs():
+    """Runs longer than 255 cells are grown along x and y"""
+    for shape in ((1, 1, 300), (1, 300, 1), (2, 300, 3)):
+        tags = np.zeros(shape, dtype=np.uint16)
+        tags.flat[-1] = 1
+        blocks = GreedyExpander().partition(tags)
+        check_partition(tags, blocks)
+        assert np.asarray(blocks[1]).max() >= 299
+
+
+@pytest.mark.parametrize('compressor', [
+    GreedyExpander(),
+    RunLength(dimension='x'),
+    RunLength(dimension='y'),
+    RunLength(dimension='z'),
+    MaximalCuboid(),
+    Octree(),
+    OptimalPartitioner(max_cells=216),
+    # too small a budget to finish the search
+    OptimalPartitioner(max_cells=216, max_nodes=20),
+], ids=lambda compressor: '{}{}'.format(
+    type(compressor).__name__, compressor.parameters))
+@pytest.mark.parametrize('seed', SEEDS)
+def test_partition_covers_cells(compressor, seed):
+    """Every partition covers each cell once, with blocks of 1 domain"""
+    tags = random_tags(seed)
+    blocks = compressor.partition(tags)
+    check_partition(tags, blocks)
+    assert len(blocks[2]) >= lower_bound(tags)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_optimal_not_worse_than_greedy(seed):
+    """
+    The OptimalPartitioner only gives a partition if it has fewer blocks
+    than the upper bound, and never leaves more blocks than the
+    GreedyExpander
+    """
+    tags = random_tags(seed)
+    greedy = GreedyExpander().partition(tags)
+    optimal = OptimalPartitioner(max_cells=216)
+    blocks = optimal.partition(tags, len(greedy[2]))
+    if blocks is not None:
+        check_partition(tags, blocks)
+        assert len(blocks[2]) < len(greedy[2])
+
+    size = Size(tags.shape[2], tags.shape[1], tags.shape[0])
+    parent_block = optimal.compress(
+        ArrayParentBlock.from_tags(size, Position(0, 0, 0), tags))
+    check_partition(tags, parent_block.block_arrays())
+    assert len(parent_block) <= len(greedy[2])
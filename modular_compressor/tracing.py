@@ -0,0 +1,231 @@
+"""
+A module for recording a timeline of a run, in the trace event format that
+Perfetto (https://ui.perfetto.dev) and chrome://tracing can open. Each span,
+such as reading a slice, a batch of parent blocks in a worker or a call of a
+compressor, becomes a complete event with the process, the thread and the
+index of the slice it was for.
+
+The main process writes the events to the trace file as it goes, a few
+thousand at a time, so the memory used by tracing stays bounded however long
+the run is. The workers keep the events of each batch, up to a limit, and
+send them back with its results, see take().
+
+Nothing is recorded until start() is called, and while tracing is disabled
+span() returns a shared context manager that does nothing.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+# whether the spans are being recorded
+enabled = False
+
+# the number of events kept in the main process before they are written
+FLUSH_EVENTS = 10000
+
+# the number of events a worker keeps for a batch, after which they are
+# dropped and counted
+MAX_WORKER_EVENTS = 100000
+
+# the events not yet written or taken
+_events = []
+
+# the number of events dropped since the last take()
+_dropped = 0
+
+# the processes, and the (pid, thread id) pairs of the threads, which have
+# been named in the trace
+_named_processes = set()
+_named = set()
+
+# the trace file, which is only open in the main process
+_file = None
+
+# whether any event has been written to the file, to separate them
+_written = False
+
+# the events are recorded from the pipeline's threads at once
+_lock = threading.Lock()
+
+# returned by span() while disabled
+_NOTHING = nullcontext()
+
+
+class _Span:
+    """A context manager which records a span as a complete event"""
+    
+    __slots__ = ('name', 'args', 'start')
+    
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.name, self.start, time.perf_counter() - self.start,
+               self.args)
+        return False
+
+
+def start(path):
+    """Starts recording the spans of the run, to a trace file at the path"""
+    global enabled, _file, _written
+    _file = open(path, 'w')
+    _file.write('[\n')
+    _written = False
+    _events.clear()
+    _named_processes.clear()
+    _named.clear()
+    enabled = True
+
+
+def stop():
+    """
+    Stops recording the spans, writes any left to the trace file and closes
+    it. Any events dropped by the workers are noted in the trace.
+    """
+    global enabled, _file
+    if _file is None:
+        return
+    enabled = False
+    if _dropped:
+        _events.append(_metadata('dropped_events', {'count': _dropped}))
+    flush()
+    _file.write('\n]\n')
+    _file.close()
+    _file = None
+
+
+def start_worker():
+    """
+    Starts recording the spans of a worker process, which are taken with
+    take() rather than written to a file
+    """
+    global enabled, _file, _dropped
+    if _file is not None or not enabled:
+        # forget anything copied from the main process when it was forked
+        _file = None
+        _events.clear()
+        _dropped = 0
+    enabled = True
+
+
+def span(name, **args):
+    """
+    Gets a context manager which records the time spent inside it as an
+    event with the name and arguments, e.g.
+        with tracing.span('read', slab=3):
+            ...
+    """
+    if not enabled:
+        return _NOTHING
+    return _Span(name, args)
+
+
+def traced(name, get_args=None):
+    """
+    A decorator which records each call of a function as a span. The
+    arguments of the event are from get_args, which is called with the
+    same arguments as the function.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            event_args = {} if get_args is None else get_args(*args, **kwargs)
+            with _Span(name, event_args):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def slab_index(parent_block):
+    """Gets the index of the slice of a parent block, from its position"""
+    return parent_block.position.z // parent_block.size.z
+
+
+def _metadata(name, args, pid=None, tid=0):
+    """Makes a metadata event"""
+    return {'name': name, 'ph': 'M', 'pid': pid or os.getpid(), 'tid': tid,
+            'args': args}
+
+
+def record(name, start, duration, args=None):
+    """
+    Records a complete event, which started at the time from
+    time.perf_counter() and lasted for the duration, both in seconds.
+    """
+    global _dropped
+    pid = os.getpid()
+    tid = threading.get_native_id()
+    event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+             'ts': start * 1e6, 'dur': duration * 1e6}
+    if args:
+        event['args'] = args
+    with _lock:
+        if _file is None and len(_events) >= MAX_WORKER_EVENTS:
+            _dropped += 1
+            return
+        if pid not in _named_processes:
+            _named_processes.add(pid)
+            _events.append(_metadata('process_name', {
+                'name': 'main' if _file is not None else 'worker'}))
+        if (pid, tid) not in _named:
+            _named.add((pid, tid))
+            _events.append(_metadata(
+                'thread_name', {'name': threading.current_thread().name},
+                pid, tid))
+        _events.append(event)
+        full = _file is not None and len(_events) >= FLUSH_EVENTS
+    if full:
+        flush()
+
+
+def take():
+    """
+    Takes the events recorded by a worker, and the number it dropped.
+    
+    Returns a tuple of the list of events and the number dropped
+    """
+    global _dropped
+    with _lock:
+        events = list(_events)
+        dropped = _dropped
+        _events.clear()
+        _dropped = 0
+    return events, dropped
+
+
+def add(recorded):
+    """Adds the events from take() in a worker to the trace"""
+    global _dropped
+    events, dropped = recorded
+    with _lock:
+        _events.extend(events)
+        _dropped += dropped
+        full = len(_events) >= FLUSH_EVENTS
+    if full:
+        flush()
+
+
+def flush():
+    """Writes the events recorded so far to the trace file"""
+    global _written
+    with _lock:
+        if _file is None or not _events:
+            return
+        text = ',\n'.join(
+            json.dumps(event, separators=(',', ':')) for event in _events)
+        _events.clear()
+        if _written:
+            _file.write(',\n')
+        _file.write(text)
+        _written = True